@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import socket
+
+from gbc_common.util import MessageReader
+from gbc_common.variables import *
+from metaclasses import ServerVerifier
+from server_core import GBChatBaseServer, BaseClientConnection
+
+logger = logging.getLogger('server_logger')
+
+
+class GBChatServerProtocol(BaseClientConnection, asyncio.Protocol):
+    def __init__(self, server):
+        super().__init__()
+        self.server = server
+        self.reader = MessageReader()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=self.server.high_water, low=self.server.low_water)
+        self.address = transport.get_extra_info('peername')[:2]
+        logger.info(f'Connected with: {self.address}')
+        self.server.metrics.accepted += 1
+
+    def pause_writing(self):
+        self.congested = True
+
+    def resume_writing(self):
+        self.congested = False
+        self.server.release_senders(self)
+
+    def data_received(self, data):
+        try:
+            for message in self.reader.feed(data):
+                self.server.process_client_message(message, self)
+                if self.transport.is_closing():
+                    break
+        except Exception:
+            logger.info(f'Client {self.address} disconnected')
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.server.client_disconnected(self)
+
+
+class GBChatAsyncServer(GBChatBaseServer, metaclass=ServerVerifier):
+    def __init__(self, listen_address, listen_port, storage, **kwargs):
+        super().__init__(listen_address, listen_port, storage, **kwargs)
+        self.loop = None
+        self.stopped = None
+
+    def init_server_socket(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.address, self.port))
+        self.sock.listen(MAX_CONNECTIONS)
+        self.sock.setblocking(False)
+        logger.info(f'server is listening at {self.address}:{self.port}')
+
+    def enqueue_frame(self, client, frame):
+        if not client.transport.is_closing():
+            client.transport.write(frame)
+
+    def outbound_queue_size(self):
+        return sum(client.transport.get_write_buffer_size() for client in self.clients_names.values()
+                   if not client.transport.is_closing())
+
+    def close_client(self, client):
+        client.transport.close()
+
+    def pause_reading(self, client):
+        if not client.transport.is_closing():
+            client.transport.pause_reading()
+
+    def resume_reading(self, client):
+        if not client.transport.is_closing():
+            client.transport.resume_reading()
+
+    def call_soon_threadsafe(self, func, *args):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def call_later(self, delay, func, *args):
+        self.loop.call_later(delay, func, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        self.init_server_socket()
+        self.on_startup()
+        server = await self.loop.create_server(lambda: GBChatServerProtocol(self), sock=self.sock)
+        async with server:
+            await self.stopped.wait()
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.on_shutdown()
@@ -0,0 +1,108 @@
+import argparse
+import datetime
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey
+from sqlalchemy.orm import mapper
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server_storage import ServerDBStorage
+
+
+# The current_users table went away with the in-memory presence registry. The baseline recreates it in its own
+# database, so the legacy functions below still run exactly as the storage did before the Core rewrite.
+class CurrentActiveUsers:
+    current_user_address = None
+    current_user_port = None
+    current_user_login_time = None
+
+    def __init__(self, user_id, user_address, user_port, user_login_time):
+        self.current_user_id = user_id
+        self.current_user_address = user_address
+        self.current_user_port = user_port
+        self.current_user_login_time = user_login_time
+
+
+def add_current_users(storage):
+    current_users_table = Table(
+        'current_users',
+        storage.metadata,
+        Column('id', Integer, primary_key=True),
+        Column('current_user_id', ForeignKey('all_users.id'), unique=True),
+        Column('current_user_address', String(15)),
+        Column('current_user_port', String(5)),
+        Column('current_user_login_time', DateTime)
+    )
+    current_users_table.create(storage.db_engine)
+    mapper(CurrentActiveUsers, current_users_table)
+    storage.CurrentActiveUsers = CurrentActiveUsers
+
+
+# The ORM login path ServerDBStorage used before the Core rewrite, kept here as the baseline
+def legacy_login_user(storage, user_name, user_address, user_port):
+    query_result = storage.session.query(storage.AllUsers).filter_by(user_name=user_name)
+    if query_result.count():
+        current_user = query_result.first()
+        current_user.last_login = datetime.datetime.now()
+    else:
+        current_user = storage.AllUsers(user_name)
+        storage.session.add(current_user)
+        storage.session.commit()
+        storage.session.add(storage.UserMessageHistory(current_user.id))
+        storage.session.add(storage.ChangeLog(None, 'user', user_name))
+    storage.session.add(storage.CurrentActiveUsers(current_user.id, user_address, user_port, datetime.datetime.now()))
+    storage.session.add(storage.LoginHistory(current_user.id, datetime.datetime.now(), user_address, user_port))
+    storage.session.commit()
+
+
+def legacy_logout_user(storage, user_name):
+    current_user = storage.session.query(storage.AllUsers).filter_by(user_name=user_name).first()
+    storage.session.query(storage.CurrentActiveUsers).filter_by(current_user_id=current_user.id).delete()
+    storage.session.commit()
+
+
+def core_login_user(storage, user_name, user_address, user_port):
+    storage.login_user(user_name, user_address, user_port)
+
+
+# Presence is kept in memory by the server now, so a logout writes nothing to the storage
+def core_logout_user(storage, user_name):
+    pass
+
+
+def run_storm(storage, login, logout, users):
+    names = [f'user-{number}' for number in range(users)]
+    results = {}
+    # First logins create the users, the second storm is the reconnect after a server restart
+    for stage in ('new users', 'returning users'):
+        start = time.perf_counter()
+        for port, name in enumerate(names, 7000):
+            login(storage, name, '127.0.0.1', port)
+        results[stage] = users / (time.perf_counter() - start)
+        for name in names:
+            logout(storage, name)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures logins per second of the server storage')
+    parser.add_argument('-u', '--users', default=2000, type=int)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        for label, login, logout in (('legacy ORM', legacy_login_user, legacy_logout_user),
+                                     ('Core', core_login_user, core_logout_user)):
+            storage = ServerDBStorage(os.path.join(db_dir, f'{label}.sqlite'))
+            if login is legacy_login_user:
+                add_current_users(storage)
+            for stage, rate in run_storm(storage, login, logout, args.users).items():
+                print(f'{label:>10} {stage:>15}: {rate:8.0f} logins/s')
+            storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+SOURCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(SOURCE_DIR)
+
+MODULES = ['server', 'server_storage', 'memory_storage', 'client', 'server_gui']
+
+
+# Runs a cold import under python -X importtime and returns (cumulative_us, {top_level_package: self_us})
+def import_breakdown(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=SOURCE_DIR,
+                            capture_output=True, text=True, check=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        entries.append((int(self_time), int(cumulative), name.strip()))
+    # Imports are listed as they finish, so the module's own imports are the entries right before it that add up
+    # to its cumulative time; anything earlier was imported by the interpreter startup
+    position = max(number for number, entry in enumerate(entries) if entry[2] == module)
+    total = entries[position][1]
+    packages = defaultdict(int)
+    collected = 0
+    while collected < total:
+        self_time, _, name = entries[position]
+        packages[name.split('.')[0]] += self_time
+        collected += self_time
+        position -= 1
+    return total, packages
+
+
+# Runs in a fresh interpreter started by startup_phases, prints the phase timings as JSON
+def measure_phases(storage_kind, port):
+    start = time.perf_counter()
+    from server import GBChatServer
+    imported = time.perf_counter()
+    with tempfile.TemporaryDirectory() as db_dir:
+        if storage_kind == 'memory':
+            from memory_storage import ServerMemoryStorage
+            storage = ServerMemoryStorage()
+        else:
+            from server_storage import ServerDBStorage
+            storage = ServerDBStorage(os.path.join(db_dir, 'bench.sqlite'))
+        created = time.perf_counter()
+        server = GBChatServer('127.0.0.1', port, storage)
+        server.init_server_socket()
+        bound = time.perf_counter()
+        server.sock.close()
+        storage.close()
+    print(json.dumps({'import server': imported - start, 'storage': created - imported, 'bind': bound - created}))
+
+
+def startup_phases(storage_kind):
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--phases', storage_kind, str(port)],
+                            cwd=SOURCE_DIR, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measures cold start of the server, storages and client')
+    parser.add_argument('--top', default=5, type=int, help='heaviest packages shown per module')
+    parser.add_argument('--phases', nargs=2, metavar=('STORAGE', 'PORT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.phases:
+        measure_phases(args.phases[0], int(args.phases[1]))
+        return
+
+    print('Cold imports (python -X importtime), ms, with the heaviest top-level packages:')
+    for module in MODULES:
+        total, packages = import_breakdown(module)
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]
+        print(f'{module:>15}: {total / 1000:7.1f}  ' +
+              ', '.join(f'{name} {self_time / 1000:.1f}' for name, self_time in heaviest))
+
+    print('Headless start phases, ms:')
+    for storage_kind in ('memory', 'sqlite'):
+        phases = startup_phases(storage_kind)
+        print(f'{storage_kind:>15}: ' +
+              '  '.join(f'{phase} {seconds * 1000:7.1f}' for phase, seconds in phases.items()))
+
+
+if __name__ == '__main__':
+    main()
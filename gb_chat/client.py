@@ -1,9 +1,11 @@
 import argparse
+import itertools
 import logging
 import os
 import socket
 import sys
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from threading import Thread, Lock
 
 from client_storage import ClientDBStorage
@@ -16,6 +18,8 @@ from metaclasses import ClientVerifier
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 SOCKET_TIMEOUT = 1
+REQUEST_TIMEOUT = 5
+USERS_SEARCH_LIMIT = 50
 
 logger = logging.getLogger('client_logger')
 socket_lock = Lock()
@@ -42,24 +46,73 @@ class GBChatClient(metaclass=ClientVerifier):
         self.sock.settimeout(SOCKET_TIMEOUT)
         self.sock.connect((self.server_address, self.server_port))
         self.storage = ClientDBStorage(self.user_name)
+        self.request_ids = itertools.count(1)
+        self.pending_requests = {}
+        self.requests_lock = Lock()
 
     def __init_storage(self):
+        with db_lock:
+            since_version = self.storage.get_sync_version()
+        request = {
+            ACTION: SYNC_REQUEST,
+            TIME: time.time(),
+            ACCOUNT_NAME: self.user_name,
+            SINCE_VERSION: since_version,
+        }
         try:
-            with socket_lock:
-                users_list = self.create_list_request_message('known', USERS_REQUEST, ACCOUNT_NAME)
+            changes = self.process_list_answer(self.send_request(request))
+            # A full snapshot leaves the user directory out, it is fetched page by page to keep every frame small.
+            # Users registering meanwhile come again with the next diff, which skips names already known.
+            if changes[SYNC_FULL]:
+                changes[USERS_ADDED] = list(self.iter_users(page_size=MAX_PAGE_SIZE))
         except ServerError as e:
             logger.error(e)
-        else:
-            self.storage.add_known_users(users_list)
-
+            return
+        logger.info(f'Synced from version {since_version} to {changes[SYNC_VERSION]}: '
+                    f'{len(changes[USERS_ADDED])} users, {len(changes[CONTACTS_ADDED])} contacts added, '
+                    f'{len(changes[CONTACTS_REMOVED])} contacts removed, full: {changes[SYNC_FULL]}')
+        with db_lock:
+            self.storage.apply_sync(changes[SYNC_VERSION], changes[SYNC_FULL], changes[USERS_ADDED],
+                                    changes[CONTACTS_ADDED], changes[CONTACTS_REMOVED])
+
+    def send_request(self, request: dict) -> Future:
+        future = Future()
+        with self.requests_lock:
+            request[REQUEST_ID] = future.request_id = next(self.request_ids)
+            self.pending_requests[request[REQUEST_ID]] = future
         try:
             with socket_lock:
-                users_list = self.create_list_request_message('contacts', GET_CONTACTS, USER)
-        except ServerError as e:
-            logger.error(e)
-        else:
-            for contact in users_list:
-                self.storage.add_contact(contact)
+                send_message(self.sock, request)
+        except OSError as e:
+            with self.requests_lock:
+                self.pending_requests.pop(request[REQUEST_ID], None)
+            future.set_exception(e)
+        return future
+
+    def resolve_request(self, answer: dict) -> bool:
+        with self.requests_lock:
+            future = self.pending_requests.pop(answer[REQUEST_ID], None)
+        if future is None:
+            return False
+        future.set_result(answer)
+        return True
+
+    # Called when the connection is gone, so nobody waits for an answer that cannot come
+    def fail_pending_requests(self, error):
+        with self.requests_lock:
+            futures, self.pending_requests = list(self.pending_requests.values()), {}
+        for future in futures:
+            future.set_exception(error)
+
+    def wait_answer(self, future: Future) -> dict:
+        try:
+            return future.result(timeout=REQUEST_TIMEOUT)
+        except FutureTimeoutError as e:
+            with self.requests_lock:
+                self.pending_requests.pop(future.request_id, None)
+            raise ServerError(f'No answer from server: {e!r}')
+        except OSError as e:
+            raise ServerError(f'No answer from server: {e!r}')
 
     def create_presence_message(self):
         logger.info(f'presence message with account {self.user_name} created')
@@ -104,36 +157,96 @@ class GBChatClient(metaclass=ClientVerifier):
                     logger.critical(f'Could not send message from {self.user_name} to {receiver}. Error: {e}')
                     sys.exit(1)
 
-    def create_list_request_message(self, list_name: str, request_action: str, request_parameter: str):
-        logger.debug(f'Requesting {list_name} users of {self.user_name}')
-        request = {
-            ACTION: request_action,
+    def create_group_text_message(self):
+        group_name = input('Please input group name to post to: ')
+        message = input('Please input message to send: ')
+        message_dict = {
+            ACTION: GROUP_MESSAGE,
+            SENDER: self.user_name,
+            GROUP_NAME: group_name,
             TIME: time.time(),
-            request_parameter: self.user_name,
+            MESSAGE_TEXT: message,
         }
-        send_message(self.sock, request)
-        answer = get_message(self.sock)
-        if RESPONSE in answer and answer[RESPONSE] == 202:
-            return answer[LIST_INFO]
-        else:
-            raise ServerError('Could not retrieve users list from server')
+        logger.debug(f'Group message dict formed: {message_dict}')
+        with socket_lock:
+            try:
+                send_message(self.sock, message_dict)
+            except OSError as e:
+                if e.errno:
+                    logger.critical(f'Could not send message from {self.user_name} to {group_name}. Error: {e}')
+                    sys.exit(1)
 
-    def create_contact_action_message(self, contact: str, message: str, action: str):
-        logger.debug(f'{message}ing contact {contact}')
+    def create_group_action_message(self, group_name: str, message: str, action: str):
+        logger.debug(f'{message} group {group_name}')
         request = {
             ACTION: action,
             TIME: time.time(),
             USER: self.user_name,
-            ACCOUNT_NAME: contact
+            GROUP_NAME: group_name
         }
-        with socket_lock:
-            send_message(self.sock, request)
-            answer = get_message(self.sock)
+        answer = self.wait_answer(self.send_request(request))
         if RESPONSE in answer and answer[RESPONSE] == 200:
             pass
         else:
-            raise ServerError(f'Could not {message} contact: {contact}')
-        print(f'Contact {contact} {message}d successfully')
+            raise ServerError(f'Could not {message} group {group_name}: {answer.get(ERROR)}')
+        print(f'Group {group_name}: {message} done')
+
+    def send_list_request(self, list_name: str, request_action: str, request_parameter: str) -> Future:
+        logger.debug(f'Requesting {list_name} users of {self.user_name}')
+        request = {
+            ACTION: request_action,
+            TIME: time.time(),
+            request_parameter: self.user_name,
+        }
+        return self.send_request(request)
+
+    def process_list_answer(self, future: Future):
+        answer = self.wait_answer(future)
+        if RESPONSE in answer and answer[RESPONSE] == 202:
+            return answer[LIST_INFO]
+        else:
+            raise ServerError('Could not retrieve users list from server')
+
+    def create_list_request_message(self, list_name: str, request_action: str, request_parameter: str):
+        return self.process_list_answer(self.send_list_request(list_name, request_action, request_parameter))
+
+    def iter_users(self, prefix=None, page_size=100):
+        cursor = None
+        while True:
+            request = {
+                ACTION: USERS_REQUEST,
+                TIME: time.time(),
+                ACCOUNT_NAME: self.user_name,
+                PAGE_SIZE: page_size,
+                CURSOR: cursor,
+                NAME_PREFIX: prefix,
+            }
+            answer = self.wait_answer(self.send_request(request))
+            if RESPONSE not in answer or answer[RESPONSE] != 202:
+                raise ServerError('Could not retrieve users list from server')
+            yield from answer[LIST_INFO]
+            cursor = answer.get(NEXT_CURSOR)
+            if not cursor:
+                return
+
+    # Sends the contacts in as few requests as the server batch limit allows, returns {contact: result}
+    def create_contacts_action_message(self, contacts: list, message: str, action: str):
+        logger.debug(f'{message}ing {len(contacts)} contacts')
+        results = {}
+        for start in range(0, len(contacts), MAX_CONTACTS_BATCH):
+            request = {
+                ACTION: action,
+                TIME: time.time(),
+                USER: self.user_name,
+                ACCOUNT_NAMES: contacts[start:start + MAX_CONTACTS_BATCH]
+            }
+            answer = self.wait_answer(self.send_request(request))
+            if RESPONSE not in answer or answer[RESPONSE] != 202:
+                raise ServerError(f'Could not {message} contacts')
+            results.update(answer[LIST_INFO])
+        for contact, result in results.items():
+            print(f'{contact}: {result}')
+        return results
 
     @staticmethod
     def process_presence_answer(message):
@@ -157,12 +270,12 @@ class GBChatClient(metaclass=ClientVerifier):
             sys.exit(1)
         print(f'{self.user_name} successfully logged in to server {self.server_address}:{self.server_port}')
 
+        receiver = GBChatClientReceiverThread(self)
+        receiver.start()
+
         self.__init_storage()
 
-        receiver = GBChatClientReceiverThread(self)
         sender = GBChatClientSenderThread(self)
-
-        receiver.start()
         sender.start()
 
         logger.info(f'Client {self.user_name} had successfully started')
@@ -177,22 +290,33 @@ class GBChatClientReceiverThread(Thread):
         self.daemon = True
         self.client = client
 
+    # The receiver is the only reader of the socket: answers are matched to pending requests by REQUEST_ID,
+    # answers arriving after their request timed out are dropped
     def run(self) -> None:
         while True:
-            time.sleep(1)
-            with socket_lock:
-                try:
-                    message = get_message(self.client.sock)
-                    if ACTION in message and message[ACTION] == MESSAGE and \
-                            SENDER in message and DESTINATION in message and MESSAGE_TEXT in message and \
-                            message[DESTINATION] == self.client.user_name:
-                        print(f'\nReceived message from {message[SENDER]}: {message[MESSAGE_TEXT]}')
-                    else:
-                        logger.error(f'Incorrect message received: {message}')
-                except OSError as e:
-                    if e.errno:
-                        logger.critical(f'{e} while receiving message. Quitting...')
-                        sys.exit(1)
+            try:
+                message = get_message(self.client.sock)
+            except socket.timeout:
+                continue
+            except (OSError, ValueError) as e:
+                logger.critical(f'{e!r} while receiving message. Quitting...')
+                self.client.fail_pending_requests(ServerError(f'Connection to server lost: {e!r}'))
+                sys.exit(1)
+            if REQUEST_ID in message:
+                if not self.client.resolve_request(message):
+                    logger.debug(f'Dropped answer to a request that timed out: {message}')
+                continue
+            if ACTION in message and message[ACTION] == MESSAGE and \
+                    SENDER in message and DESTINATION in message and MESSAGE_TEXT in message and \
+                    message[DESTINATION] == self.client.user_name:
+                print(f'\nReceived message from {message[SENDER]}: {message[MESSAGE_TEXT]}')
+            elif ACTION in message and message[ACTION] == GROUP_MESSAGE and \
+                    SENDER in message and GROUP_NAME in message and MESSAGE_TEXT in message:
+                print(f'\n[{message[GROUP_NAME]}] {message[SENDER]}: {message[MESSAGE_TEXT]}')
+            elif RESPONSE in message and ERROR in message:
+                print(f'\nServer error: {message[ERROR]}')
+            else:
+                logger.error(f'Incorrect message received: {message}')
 
 
 class GBChatClientSenderThread(Thread):
@@ -201,28 +325,66 @@ class GBChatClientSenderThread(Thread):
         self.daemon = True
         self.client = client
 
+    @staticmethod
+    def input_contacts(answer):
+        if answer.startswith('import'):
+            with open(input('Input file with one contact per line: '), encoding='utf-8') as contacts_file:
+                names = [line.strip() for line in contacts_file]
+        else:
+            names = [name.strip() for name in input('Input contacts separated by commas: ').split(',')]
+        return [name for name in names if name]
+
     def edit_contacts(self):
-        answer = input('Input del to delete contact, or add for adding: ')
+        answer = input('Input del to delete contacts, add for adding or import to add contacts from a file: ')
         if answer == 'del':
-            contact = input('Input contact to delete: ')
+            contacts = self.input_contacts(answer)
             with db_lock:
-                if self.client.storage.contact_exists(contact):
-                    self.client.storage.delete_contact(contact)
-                    try:
-                        self.client.create_contact_action_message(contact, 'delete', REMOVE_CONTACT)
-                    except ServerError:
-                        logger.error('Could not delete contact on server.')
-                else:
+                if not any(self.client.storage.contact_exists(contact) for contact in contacts):
                     logger.error('No contact to delete.')
-        elif answer == 'add':
-            contact = input('Input contact to add: ')
+                    return
+                try:
+                    results = self.client.create_contacts_action_message(contacts, 'delete', REMOVE_CONTACT)
+                except ServerError:
+                    logger.error('Could not delete contacts on server.')
+                    return
+                self.client.storage.delete_contacts(list(results))
+        elif answer in ('add', 'import'):
+            contacts = self.input_contacts(answer)
+            if not contacts:
+                return
             with db_lock:
-                if self.client.storage.known_user_exists(contact):
-                    self.client.storage.add_contact(contact)
-                    try:
-                        self.client.create_contact_action_message(contact, 'create', ADD_CONTACT)
-                    except ServerError:
-                        logger.error('Could not delete contact on server.')
+                try:
+                    results = self.client.create_contacts_action_message(contacts, 'create', ADD_CONTACT)
+                except ServerError:
+                    logger.error('Could not add contacts on server.')
+                    return
+                self.client.storage.add_contacts(
+                    [contact for contact, result in results.items() if result in (CONTACT_ADDED, CONTACT_UNCHANGED)])
+
+    def edit_groups(self):
+        answer = input('Input create, join, leave or post: ')
+        actions = {'create': GROUP_CREATE, 'join': GROUP_JOIN, 'leave': GROUP_LEAVE}
+        if answer == 'post':
+            self.client.create_group_text_message()
+        elif answer in actions:
+            group_name = input('Input group name: ')
+            try:
+                self.client.create_group_action_message(group_name, answer, actions[answer])
+            except ServerError as e:
+                logger.error(e)
+                print(e)
+        else:
+            print('Incorrect command')
+
+    def search_users(self):
+        prefix = input('Input beginning of user name (Enter for all): ')
+        try:
+            users_list = list(itertools.islice(self.client.iter_users(prefix or None), USERS_SEARCH_LIMIT))
+        except ServerError as e:
+            logger.error(e)
+            print(e)
+        else:
+            print('Users:', ', '.join(users_list))
 
     def print_history(self):
         command = input('Show incoming messages- in, outgoing - out, all - просто Enter: ')
@@ -251,6 +413,8 @@ class GBChatClientSenderThread(Thread):
         print('history')
         print('contacts')
         print('edit')
+        print('group')
+        print('users')
         print('help')
         print('exit')
 
@@ -274,6 +438,10 @@ class GBChatClientSenderThread(Thread):
                 print('Contacts:', ', '.join(contacts_list))
             elif command == 'edit':
                 self.edit_contacts()
+            elif command == 'group':
+                self.edit_groups()
+            elif command == 'users':
+                self.search_users()
             elif command == 'history':
                 self.print_history()
             else:
@@ -26,6 +26,12 @@ class ClientDBStorage:
         def __init__(self, user_name):
             self.contact_user_name = user_name
 
+    class SyncState:
+        sync_version = None
+
+        def __init__(self, version):
+            self.sync_version = version
+
     def __init__(self, user_name):
         self.db_engine = create_engine(f'sqlite:///client_{user_name}_db.sqlite', echo=False,
                                        pool_recycle=RECYCLE_PERIOD, connect_args={'check_same_thread': False})
@@ -51,14 +57,19 @@ class ClientDBStorage:
             Column('id', Integer, primary_key=True),
             Column('contact_user_name', String, unique=True)
         )
+        sync_state_table = Table(
+            'sync_state',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('sync_version', Integer)
+        )
         self.metadata.create_all(self.db_engine)
         mapper(self.KnownUsers, known_users_table)
         mapper(self.MessageHistory, message_history_table)
         mapper(self.Contacts, contacts_table)
+        mapper(self.SyncState, sync_state_table)
 
         self.session = sessionmaker(bind=self.db_engine)()
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
 
     def add_contact(self, contact_name):
         if not self.session.query(self.Contacts).filter_by(contact_user_name=contact_name).count():
@@ -69,12 +80,51 @@ class ClientDBStorage:
         self.session.query(self.Contacts).filter_by(contact_user_name=contact_name).delete()
         self.session.commit()
 
+    def add_contacts(self, contact_names):
+        existing = {row[0] for row in self.session.query(self.Contacts.contact_user_name)}
+        self.session.add_all([self.Contacts(name) for name in dict.fromkeys(contact_names) if name not in existing])
+        self.session.commit()
+
+    def delete_contacts(self, contact_names):
+        self.session.query(self.Contacts).filter(self.Contacts.contact_user_name.in_(contact_names)).delete(
+            synchronize_session=False)
+        self.session.commit()
+
     def add_known_users(self, known_users_list):
         self.session.query(self.KnownUsers).delete()
         for user in known_users_list:
             self.session.add(self.KnownUsers(user))
         self.session.commit()
 
+    def get_sync_version(self):
+        state = self.session.query(self.SyncState).first()
+        return state.sync_version if state else 0
+
+    # Applies a server diff (or a full snapshot) and stores the new version in one transaction
+    def apply_sync(self, version, full, users_added, contacts_added, contacts_removed):
+        if full:
+            self.session.query(self.KnownUsers).delete()
+            self.session.query(self.Contacts).delete()
+            known_users = set()
+            current_contacts = set()
+        else:
+            known_users = {user[0] for user in self.session.query(self.KnownUsers.known_user_name).filter(
+                self.KnownUsers.known_user_name.in_(users_added))}
+            current_contacts = {contact[0] for contact in self.session.query(self.Contacts.contact_user_name).filter(
+                self.Contacts.contact_user_name.in_(contacts_added))}
+            if contacts_removed:
+                self.session.query(self.Contacts).filter(self.Contacts.contact_user_name.in_(contacts_removed)).delete(
+                    synchronize_session=False)
+        self.session.add_all([self.KnownUsers(user) for user in dict.fromkeys(users_added) if user not in known_users])
+        self.session.add_all(
+            [self.Contacts(contact) for contact in dict.fromkeys(contacts_added) if contact not in current_contacts])
+        state = self.session.query(self.SyncState).first()
+        if state:
+            state.sync_version = version
+        else:
+            self.session.add(self.SyncState(version))
+        self.session.commit()
+
     def save_message(self, from_user, to_user, message):
         self.session.add(self.MessageHistory(from_user, to_user, message))
         self.session.commit()
@@ -1,22 +1,76 @@
+import errno
 import json
+import struct
+import weakref
+from collections import deque
 
-from .variables import BUFFER_SIZE, ENCODING
+from .variables import BUFFER_SIZE, ENCODING, MAX_MESSAGE_SIZE
 from logs.log_decorator import log
 
+# Every message on the wire is a 4-byte big-endian payload length followed by the JSON payload
+HEADER = struct.Struct('!I')
 
-@log
-def get_message(client_socket):
+
+class MessageReader:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.pending = deque()
+
+    def feed(self, data):
+        if not isinstance(data, (bytes, bytearray)):
+            raise ValueError
+        self.buffer += data
+        messages = []
+        while len(self.buffer) >= HEADER.size:
+            (length,) = HEADER.unpack_from(self.buffer)
+            if length > MAX_MESSAGE_SIZE:
+                raise ValueError(f'Message of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE} bytes')
+            frame_end = HEADER.size + length
+            if len(self.buffer) < frame_end:
+                break
+            payload = bytes(self.buffer[HEADER.size:frame_end])
+            del self.buffer[:frame_end]
+            messages.append(decode_message(payload))
+        return messages
+
+
+_socket_readers = weakref.WeakKeyDictionary()
+
+
+def encode_message(message):
+    if not isinstance(message, dict):
+        raise TypeError
+    payload = json.dumps(message).encode(ENCODING)
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload):
+    json_result = json.loads(payload.decode(ENCODING))
+    if not isinstance(json_result, dict):
+        raise ValueError
+    return json_result
+
+
+def recv_messages(client_socket, reader):
     raw_response = client_socket.recv(BUFFER_SIZE)
     if not isinstance(raw_response, bytes):
         raise ValueError
-    str_response = raw_response.decode(ENCODING)
-    json_result = json.loads(str_response)
-    return json_result
+    # Callers tell a closed connection from a socket timeout by errno, so the EOF carries one too
+    if not raw_response:
+        raise ConnectionResetError(errno.ECONNRESET, 'Connection closed by peer')
+    return reader.feed(raw_response)
+
+
+@log
+def get_message(client_socket):
+    reader = _socket_readers.get(client_socket)
+    if reader is None:
+        reader = _socket_readers[client_socket] = MessageReader()
+    while not reader.pending:
+        reader.pending.extend(recv_messages(client_socket, reader))
+    return reader.pending.popleft()
 
 
 @log
 def send_message(sock, message):
-    if not isinstance(message, dict):
-        raise TypeError
-    json_message = json.dumps(message)
-    sock.send(json_message.encode(ENCODING))
+    sock.sendall(encode_message(message))
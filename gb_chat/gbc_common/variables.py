@@ -2,8 +2,29 @@ DEFAULT_SERVER_PORT = 7777
 DEFAULT_SERVER_LISTEN_ADDRESS = ''
 DEFAULT_SERVER_ADDRESS = '127.0.0.1'
 
-MAX_CONNECTIONS = 10
+MAX_CONNECTIONS = 128
 BUFFER_SIZE = 4096
+MAX_MESSAGE_SIZE = 1024 * 1024
+OUTBOUND_HIGH_WATER = 256 * 1024
+OUTBOUND_LOW_WATER = 64 * 1024
+
+HISTORY_FLUSH_INTERVAL = 1.0
+HISTORY_FLUSH_SIZE = 1000
+
+OFFLINE_BACKLOG_LIMIT = 100
+OFFLINE_MESSAGE_TTL = 7 * 24 * 60 * 60
+
+LOGIN_HISTORY_MAX_AGE = 90
+LOGIN_HISTORY_MAX_ROWS = 1000000
+LOGIN_HISTORY_ROLLUP_BATCH = 500
+LOGIN_HISTORY_ROLLUP_INTERVAL = 60 * 60
+VACUUM_PAGES = 1000
+SNAPSHOT_INTERVAL = 60.0
+
+METRICS_INTERVAL = 1.0
+METRICS_SAMPLES = 300
+# Seconds between stats events sent to the server event listeners
+STATS_EVENT_INTERVAL = 0.05
 
 ENCODING = 'utf-8'
 
@@ -13,6 +34,7 @@ USER = 'user'
 ACCOUNT_NAME = 'account_name'
 SENDER = 'sender'
 DESTINATION = 'to'
+REQUEST_ID = 'request_id'
 
 PRESENCE = 'presence'
 RESPONSE = 'response'
@@ -22,11 +44,35 @@ GET_CONTACTS = 'get_contacts'
 LIST_INFO = 'data_list'
 REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
+ACCOUNT_NAMES = 'account_names'
+MAX_CONTACTS_BATCH = 1000
+CONTACT_ADDED = 'added'
+CONTACT_REMOVED = 'removed'
+CONTACT_UNCHANGED = 'unchanged'
+CONTACT_UNKNOWN = 'unknown'
 USERS_REQUEST = 'get_users'
+PAGE_SIZE = 'page_size'
+CURSOR = 'cursor'
+NEXT_CURSOR = 'next_cursor'
+NAME_PREFIX = 'prefix'
+MAX_PAGE_SIZE = 500
+SYNC_REQUEST = 'sync'
+SINCE_VERSION = 'since_version'
+SYNC_VERSION = 'version'
+SYNC_FULL = 'full'
+USERS_ADDED = 'users_added'
+CONTACTS_ADDED = 'contacts_added'
+CONTACTS_REMOVED = 'contacts_removed'
 
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
 
+GROUP_NAME = 'group_name'
+GROUP_CREATE = 'create_group'
+GROUP_JOIN = 'join_group'
+GROUP_LEAVE = 'leave_group'
+GROUP_MESSAGE = 'group_message'
+
 OK_RESPONSE = {RESPONSE: 200}
 ACCEPTED_RESPONSE = {RESPONSE: 202, LIST_INFO: None}
 ERROR_RESPONSE = {
@@ -0,0 +1,350 @@
+import bisect
+import datetime
+import json
+import logging
+import os
+from collections import deque, defaultdict
+from functools import wraps
+from threading import RLock, Thread, Event
+
+from gbc_common.variables import CONTACT_ADDED, CONTACT_REMOVED, CONTACT_UNCHANGED, CONTACT_UNKNOWN
+from storage_base import BaseServerStorage
+
+logger = logging.getLogger('server_logger')
+
+
+# The GUI reads listings from its own thread while the storage executor mutates the state
+def synchronized(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+class ServerMemoryStorage(BaseServerStorage):
+    class User:
+        def __init__(self, last_login_time=None, sent=0, received=0):
+            self.last_login_time = last_login_time
+            self.sent = sent
+            self.received = received
+            # Dicts keep contacts in the order they were added
+            self.contacts = {}
+            self.offline_messages = deque()
+
+    def __init__(self, snapshot_path=None, snapshot_interval=None):
+        self.lock = RLock()
+        self.users = {}
+        self.sorted_names = []
+        # (last_login_time, name) in order, kept up to date on login; counter orders are sorted on demand
+        self.login_order = []
+        self.counters_version = 0
+        self.counter_orders = {}
+        self.history = deque()
+        self.login_daily = defaultdict(int)
+        self.groups = {}
+        # Changes are numbered by one shared counter, which is the sync version
+        self.version = 0
+        self.user_changes = []
+        self.contact_changes = defaultdict(list)
+        self.snapshot_path = snapshot_path
+        self.snapshot_stopped = Event()
+        self.snapshot_thread = None
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load_snapshot()
+        if snapshot_path and snapshot_interval:
+            self.snapshot_thread = Thread(target=self.snapshot_loop, args=(snapshot_interval,), daemon=True)
+            self.snapshot_thread.start()
+
+    def add_user(self, user_name):
+        self.users[user_name] = self.User()
+        bisect.insort(self.sorted_names, user_name)
+        self.version += 1
+        self.user_changes.append((self.version, user_name))
+
+    def log_contact_change(self, user, contact, removed):
+        self.version += 1
+        self.contact_changes[user].append((self.version, contact, removed))
+
+    @synchronized
+    def login_user(self, user_name, user_address, user_port):
+        now = datetime.datetime.now()
+        if user_name not in self.users:
+            self.add_user(user_name)
+        user = self.users[user_name]
+        old_key = (user.last_login_time or datetime.datetime.min, user_name)
+        position = bisect.bisect_left(self.login_order, old_key)
+        if position < len(self.login_order) and self.login_order[position] == old_key:
+            del self.login_order[position]
+        user.last_login_time = now
+        bisect.insort(self.login_order, (now, user_name))
+        self.history.append((user_name, now, str(user_address), str(user_port)))
+
+    @synchronized
+    def message_history_bulk_update(self, counters):
+        self.counters_version += 1
+        for name, (sent, received) in counters.items():
+            user = self.users.get(name)
+            if user:
+                user.sent += sent
+                user.received += received
+
+    @synchronized
+    def store_offline_messages(self, user_name, messages, backlog_limit=None):
+        user = self.users.get(user_name)
+        if not user or not messages:
+            return 0
+        now = datetime.datetime.now()
+        user.offline_messages.extend((message, now) for message in messages)
+        while backlog_limit and len(user.offline_messages) > backlog_limit:
+            user.offline_messages.popleft()
+        return len(messages)
+
+    @synchronized
+    def pop_offline_messages(self, user_name, ttl=None):
+        user = self.users.get(user_name)
+        if not user:
+            return []
+        messages, user.offline_messages = user.offline_messages, deque()
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=ttl) if ttl else datetime.datetime.min
+        return [message for message, created in messages if created >= oldest]
+
+    @synchronized
+    def purge_offline_messages(self, ttl):
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+        deleted = 0
+        for user in self.users.values():
+            while user.offline_messages and user.offline_messages[0][1] < oldest:
+                user.offline_messages.popleft()
+                deleted += 1
+        return deleted
+
+    @synchronized
+    def create_group(self, user_name, group_name):
+        if user_name not in self.users or group_name in self.groups:
+            return False
+        self.groups[group_name] = {user_name: None}
+        return True
+
+    @synchronized
+    def join_group(self, user_name, group_name):
+        if user_name not in self.users or group_name not in self.groups:
+            return False
+        self.groups[group_name][user_name] = None
+        return True
+
+    @synchronized
+    def leave_group(self, user_name, group_name):
+        if user_name not in self.users or user_name not in self.groups.get(group_name, {}):
+            return False
+        del self.groups[group_name][user_name]
+        return True
+
+    @synchronized
+    def group_members_list(self):
+        return [(group_name, user_name) for group_name, members in self.groups.items() for user_name in members]
+
+    @synchronized
+    def add_contacts(self, user, contacts):
+        current_user = self.users.get(user)
+        results = {}
+        for contact in contacts:
+            if not current_user or contact not in self.users:
+                results[contact] = CONTACT_UNKNOWN
+            elif contact in current_user.contacts:
+                results.setdefault(contact, CONTACT_UNCHANGED)
+            else:
+                current_user.contacts[contact] = None
+                self.log_contact_change(user, contact, False)
+                results[contact] = CONTACT_ADDED
+        return results
+
+    @synchronized
+    def delete_contacts(self, user, contacts):
+        current_user = self.users.get(user)
+        results = {}
+        for contact in contacts:
+            if not current_user or contact not in self.users:
+                results[contact] = CONTACT_UNKNOWN
+            elif contact not in current_user.contacts:
+                results.setdefault(contact, CONTACT_UNCHANGED)
+            else:
+                del current_user.contacts[contact]
+                self.log_contact_change(user, contact, True)
+                results[contact] = CONTACT_REMOVED
+        return results
+
+    @synchronized
+    def get_all_contacts(self, user):
+        current_user = self.users.get(user)
+        return list(current_user.contacts) if current_user else []
+
+    @synchronized
+    def current_version(self):
+        return self.version
+
+    @synchronized
+    def get_changes(self, user_name, since_version):
+        if user_name not in self.users or since_version <= 0 or since_version > self.version:
+            return self.version, True, [], self.get_all_contacts(user_name), []
+        # Both change lists are ordered by version, so the diff starts at the first change after since_version
+        users_start = bisect.bisect_left(self.user_changes, (since_version + 1,))
+        users_added = [name for _, name in self.user_changes[users_start:]]
+        contact_changes = self.contact_changes.get(user_name, [])
+        contacts_start = bisect.bisect_left(contact_changes, (since_version + 1,))
+        contacts = {}
+        for _, name, removed in contact_changes[contacts_start:]:
+            contacts[name] = removed
+        return (self.version, False, users_added, [name for name, removed in contacts.items() if not removed],
+                [name for name, removed in contacts.items() if removed])
+
+    @synchronized
+    def users_page(self, page_size, after_name=None, prefix=None):
+        start = 0
+        if prefix:
+            start = bisect.bisect_left(self.sorted_names, prefix)
+        if after_name is not None:
+            start = max(start, bisect.bisect_right(self.sorted_names, after_name))
+        names = []
+        for name in self.sorted_names[start:start + page_size + 1]:
+            if prefix and not name.startswith(prefix):
+                break
+            names.append(name)
+        return names[:page_size], len(names) > page_size
+
+    @synchronized
+    def all_users_list(self):
+        return [(name, user.last_login_time) for name, user in self.users.items()]
+
+    @synchronized
+    def history_list(self, user_name=None):
+        return [entry for entry in self.history if not user_name or entry[0] == user_name]
+
+    @synchronized
+    def message_history_list(self):
+        return [(name, user.last_login_time, user.sent, user.received) for name, user in self.users.items()]
+
+    # Sorted (value, name) keys for a message_history_page column
+    def sort_order(self, sort_column):
+        if sort_column == 0:
+            return self.sorted_names
+        if sort_column == 1:
+            return self.login_order
+        version, keys = self.counter_orders.get(sort_column, (None, None))
+        if version != self.counters_version:
+            keys = sorted(((user.sent, name) if sort_column == 2 else (user.received, name))
+                          for name, user in self.users.items())
+            self.counter_orders[sort_column] = (self.counters_version, keys)
+        return keys
+
+    # A page starts with a bisect from the cursor, so it costs the page, not the user count, once the order exists.
+    # Names sort by themselves, login times are ordered on login; a counters column is sorted again after the
+    # counters changed, which makes its first page after a flush O(n log n).
+    @synchronized
+    def message_history_page(self, page_size, sort_column=0, descending=False, cursor=None, name_filter=None):
+        keys = self.sort_order(sort_column)
+        if descending:
+            positions = range((len(keys) if cursor is None else bisect.bisect_left(keys, cursor)) - 1, -1, -1)
+        else:
+            positions = range(0 if cursor is None else bisect.bisect_right(keys, cursor), len(keys))
+        page = []
+        for position in positions:
+            key = keys[position]
+            name = key if sort_column == 0 else key[1]
+            if name_filter and name_filter not in name:
+                continue
+            page.append(key)
+            if len(page) > page_size:
+                break
+        rows = []
+        for key in page[:page_size]:
+            name = key if sort_column == 0 else key[1]
+            user = self.users[name]
+            rows.append((name, user.last_login_time, user.sent, user.received))
+        return rows, page[page_size - 1] if len(page) > page_size else None
+
+    @synchronized
+    def login_daily_list(self, user_name=None):
+        return sorted(((name, date, logins) for (name, date), logins in self.login_daily.items()
+                       if not user_name or name == user_name), key=lambda entry: entry[1])
+
+    @synchronized
+    def rollup_login_history(self, max_age_days, max_rows, batch_size):
+        oldest = datetime.datetime.now() - datetime.timedelta(days=max_age_days) if max_age_days else None
+        rolled_up = 0
+        while self.history and rolled_up < batch_size:
+            user_name, login_time, _, _ = self.history[0]
+            if not (oldest and login_time < oldest or max_rows and len(self.history) > max_rows):
+                break
+            self.history.popleft()
+            self.login_daily[(user_name, login_time.date())] += 1
+            rolled_up += 1
+        return rolled_up
+
+    @synchronized
+    def snapshot(self):
+        return {
+            'version': self.version,
+            'users': {name: {
+                'last_login_time': user.last_login_time.isoformat() if user.last_login_time else None,
+                'sent': user.sent,
+                'received': user.received,
+                'contacts': list(user.contacts),
+                'offline_messages': [(message, created.isoformat()) for message, created in user.offline_messages],
+            } for name, user in self.users.items()},
+            'history': [(name, login_time.isoformat(), address, port) for name, login_time, address, port in
+                        self.history],
+            'login_daily': [(name, date.isoformat(), logins) for (name, date), logins in self.login_daily.items()],
+            'groups': {group_name: list(members) for group_name, members in self.groups.items()},
+            'user_changes': list(self.user_changes),
+            'contact_changes': {user_name: list(changes) for user_name, changes in self.contact_changes.items()},
+        }
+
+    # The snapshot is written to a temporary file first, so a crash never leaves a truncated one behind
+    def save_snapshot(self):
+        state = self.snapshot()
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as snapshot_file:
+            json.dump(state, snapshot_file)
+        os.replace(temp_path, self.snapshot_path)
+
+    @synchronized
+    def load_snapshot(self):
+        with open(self.snapshot_path, encoding='utf-8') as snapshot_file:
+            state = json.load(snapshot_file)
+        parse_time = datetime.datetime.fromisoformat
+        self.version = state['version']
+        for name, fields in state['users'].items():
+            user = self.users[name] = self.User(
+                parse_time(fields['last_login_time']) if fields['last_login_time'] else None,
+                fields['sent'], fields['received'])
+            user.contacts = dict.fromkeys(fields['contacts'])
+            user.offline_messages = deque((message, parse_time(created))
+                                          for message, created in fields['offline_messages'])
+        self.sorted_names = sorted(self.users)
+        self.login_order = sorted((user.last_login_time or datetime.datetime.min, name)
+                                  for name, user in self.users.items())
+        self.history = deque((name, parse_time(login_time), address, port)
+                             for name, login_time, address, port in state['history'])
+        for name, date, logins in state['login_daily']:
+            self.login_daily[(name, datetime.date.fromisoformat(date))] = logins
+        self.groups = {group_name: dict.fromkeys(members) for group_name, members in state['groups'].items()}
+        self.user_changes = [tuple(change) for change in state['user_changes']]
+        for user_name, changes in state['contact_changes'].items():
+            self.contact_changes[user_name] = [tuple(change) for change in changes]
+        logger.info(f'Loaded storage snapshot {self.snapshot_path} at version {self.version}')
+
+    def snapshot_loop(self, interval):
+        while not self.snapshot_stopped.wait(interval):
+            try:
+                self.save_snapshot()
+            except OSError as error:
+                logger.error(f'Cannot save storage snapshot: {error!r}')
+
+    def close(self):
+        self.snapshot_stopped.set()
+        if self.snapshot_thread:
+            self.snapshot_thread.join()
+        if self.snapshot_path:
+            self.save_snapshot()
@@ -0,0 +1,79 @@
+import datetime
+from collections import namedtuple
+from threading import Lock
+
+Presence = namedtuple('Presence', ['name', 'address', 'port', 'login_time', 'sent', 'received'])
+# What the server tells its listeners about; kind is one of the *_EVENT constants, stats events carry no name
+PresenceEvent = namedtuple('PresenceEvent', ['kind', 'name'])
+
+LOGIN_EVENT = 'login'
+LOGOUT_EVENT = 'logout'
+STATS_EVENT = 'stats'
+
+PRESENCE_TOMBSTONES = 1024
+
+
+# Online users, owned by the server and read by the GUI thread. Every change gets the next version, so a reader
+# holding an older version can ask only for what changed since then.
+class PresenceRegistry:
+    def __init__(self, tombstones=PRESENCE_TOMBSTONES):
+        self.lock = Lock()
+        self.version = 0
+        # name: [address, port, login_time, sent, received, version]
+        self.entries = {}
+        # Logged out names with the version of their removal, oldest first
+        self.removed = {}
+        self.tombstones = tombstones
+        self.removed_floor = 0
+
+    def login(self, name, address, port):
+        with self.lock:
+            self.version += 1
+            self.removed.pop(name, None)
+            self.entries[name] = [address, port, datetime.datetime.now(), 0, 0, self.version]
+
+    def logout(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is None:
+                return
+            self.version += 1
+            self.removed[name] = self.version
+            if len(self.removed) > self.tombstones:
+                oldest = next(iter(self.removed))
+                self.removed_floor = self.removed.pop(oldest)
+
+    def count_message(self, sender, recipients):
+        with self.lock:
+            self.version += 1
+            if sender in self.entries:
+                self.entries[sender][3] += 1
+                self.entries[sender][5] = self.version
+            for recipient in recipients:
+                if recipient in self.entries:
+                    self.entries[recipient][4] += 1
+                    self.entries[recipient][5] = self.version
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def make_presence(name, entry):
+        return Presence(name, *entry[:5])
+
+    def snapshot(self):
+        with self.lock:
+            return self.version, [self.make_presence(name, entry) for name, entry in self.entries.items()]
+
+    # Returns (version, full, changed, removed_names); a version older than the kept tombstones gets a full snapshot
+    def diff(self, since_version):
+        with self.lock:
+            if since_version < self.removed_floor or since_version > self.version:
+                return self.version, True, [self.make_presence(name, entry) for name, entry in
+                                            self.entries.items()], []
+            changed = [self.make_presence(name, entry) for name, entry in self.entries.items()
+                       if entry[5] > since_version]
+            removed = [name for name, version in self.removed.items() if version > since_version]
+            return self.version, False, changed, removed
@@ -1,186 +1,243 @@
 import argparse
 import logging
 import os
+import signal
 import socket
 import sys
 import configparser
-from threading import Thread, Lock
 
-import select
-from PyQt5.QtCore import QTimer
-from PyQt5.QtWidgets import QApplication, QMessageBox
+import heapq
+import itertools
+import selectors
+import time
+from collections import deque
 
-from descrs import PortDescriptor
-from gbc_common.util import get_message, send_message
+from gbc_common.util import MessageReader, recv_messages
 from gbc_common.variables import *
 from metaclasses import ServerVerifier
-from server_gui import ServerGUIMainWindow, get_active_users_model, ServerGUIHistoryWindow, get_history_model, \
-    ServerGUIConfigWindow, db_lock
-from server_storage import ServerDBStorage
+from server_core import GBChatBaseServer, BaseClientConnection
 
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 logger = logging.getLogger('server_logger')
 
-new_connection = True
-new_connection_lock = Lock()
 
-
-def parse_arguments(default_port, default_address):
+def parse_arguments(default_port, default_address, default_engine='threaded', default_headless=False):
     parser = argparse.ArgumentParser(description='GB CLI chat server')
     parser.add_argument('-p', dest='port', default=default_port, type=int)
     parser.add_argument('-a', dest='address', default=default_address)
+    parser.add_argument('-e', '--engine', dest='engine', default=default_engine, choices=['threaded', 'asyncio'])
+    parser.add_argument('--headless', action='store_true', default=default_headless,
+                        help='run without the GUI until SIGINT or SIGTERM')
     args = parser.parse_args()
-    return args.address, args.port
-
-
-class GBChatServer(Thread, metaclass=ServerVerifier):
-    port = PortDescriptor()
-
-    def __init__(self, listen_address, listen_port, storage):
-        super().__init__()
-        self.daemon = True
-        self.address = listen_address
-        self.port = listen_port
-        self.clients_list = []
-        self.messages_list = []
-        self.clients_names = {}
-        self.storage = storage
-        self.sock = None
+    return args.address, args.port, args.engine, args.headless
+
+
+class ClientConnection(BaseClientConnection):
+    def __init__(self, sock, address):
+        super().__init__(address)
+        self.sock = sock
+        self.reader = MessageReader()
+        self.outgoing = deque()
+        self.outgoing_size = 0
+        self.events = 0
+        self.reading_paused = False
+        self.closed = False
+        self.close_after_flush = False
+
+
+class GBChatServer(GBChatBaseServer, metaclass=ServerVerifier):
+    def __init__(self, listen_address, listen_port, storage, **kwargs):
+        super().__init__(listen_address, listen_port, storage, **kwargs)
+        self.selector = None
+        # Storage results are handed back to the network thread through this queue and socket pair
+        self.pending_callbacks = deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.timers = []
+        self.timers_counter = itertools.count()
+        self.running = False
 
     def init_server_socket(self):
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.address, self.port))
         self.sock.listen(MAX_CONNECTIONS)
-        self.sock.settimeout(0.5)
+        self.sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
         logger.info(f'server is listening at {self.address}:{self.port}')
 
-    def send_message_to_client(self, message, clients_sockets):
-        if message[DESTINATION] in self.clients_names and self.clients_names[message[DESTINATION]] in clients_sockets:
-            send_message(self.clients_names[message[DESTINATION]], message)
-            with db_lock:
-                self.storage.message_history_update(message[SENDER], message[DESTINATION])
-        else:
-            error_text = f'Cannot send message to {message[DESTINATION]}'
-            logger.error(error_text)
-            raise Exception(error_text)
-
-    def process_client_message(self, message: dict, client: socket):
-        global new_connection
-        logger.debug(f'Processing message from client: {message}')
-
-        # Process PRESENCE message
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            if message[USER][ACCOUNT_NAME] not in self.clients_names:
-                self.clients_names[message[USER][ACCOUNT_NAME]] = client
-                address, port = client.getpeername()
-                with db_lock, new_connection_lock:
-                    self.storage.login_user(message[USER][ACCOUNT_NAME], address, port)
-                    new_connection = True
-                send_message(client, OK_RESPONSE)
-            else:
-                response = ERROR_RESPONSE
-                response[ERROR] = f'Name {message[USER][ACCOUNT_NAME]} is already taken'
-                send_message(client, response)
-                self.clients_list.remove(client)
-                client.close()
-            return
-
-        # Process MESSAGE message
-        elif ACTION in message and message[ACTION] == MESSAGE and TIME in message and MESSAGE_TEXT in message and \
-                SENDER in message and DESTINATION in message:
-            self.messages_list.append(message)
-            return
-
-        # Process EXIT message
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
-            self.clients_list.remove(self.clients_names[message[ACCOUNT_NAME]])
-            with db_lock:
-                self.storage.logout_user(message[ACCOUNT_NAME])
-            self.clients_names[message[ACCOUNT_NAME]].close()
-            del self.clients_names[message[ACCOUNT_NAME]]
-            with new_connection_lock:
-                new_connection = True
+    def _update_interest(self, client):
+        events = 0
+        if not client.reading_paused:
+            events |= selectors.EVENT_READ
+        if client.outgoing:
+            events |= selectors.EVENT_WRITE
+        if events == client.events:
             return
+        if not client.events:
+            self.selector.register(client.sock, events, client)
+        elif not events:
+            self.selector.unregister(client.sock)
+        else:
+            self.selector.modify(client.sock, events, client)
+        client.events = events
 
-        # Process GET_CONTACTS message
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.clients_names[message[USER]] == client:
-            response = ACCEPTED_RESPONSE
-            with db_lock:
-                response[LIST_INFO] = self.storage.get_all_contacts(message[USER])
-            send_message(client, response)
+    def enqueue_frame(self, client, frame):
+        if client.closed:
             return
+        client.outgoing.append(frame)
+        client.outgoing_size += len(frame)
+        if client.outgoing_size > self.high_water:
+            client.congested = True
+        self._update_interest(client)
+
+    def outbound_queue_size(self):
+        return sum(client.outgoing_size for client in self.clients_names.values())
+
+    def close_client(self, client):
+        if not client.outgoing:
+            self._remove_client(client)
+        else:
+            client.close_after_flush = True
 
-        # Process ADD_CONTACT message
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.clients_names[message[USER]] == client:
-            with db_lock:
-                self.storage.add_contact(message[USER], message[ACCOUNT_NAME])
-            send_message(client, OK_RESPONSE)
-            return
+    def call_soon_threadsafe(self, func, *args):
+        self.pending_callbacks.append((func, args))
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
 
-        # Process REMOVE_CONTACT message
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.clients_names[message[USER]] == client:
-            with db_lock:
-                self.storage.delete_contact(message[USER], message[ACCOUNT_NAME])
-            send_message(client, OK_RESPONSE)
-            return
+    def call_later(self, delay, func, *args):
+        heapq.heappush(self.timers, (time.monotonic() + delay, next(self.timers_counter), func, args))
 
-        # Process USERS_REQUEST message
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.clients_names[message[ACCOUNT_NAME]] == client:
-            response = ACCEPTED_RESPONSE
-            with db_lock:
-                response[LIST_INFO] = [user[0] for user in self.storage.all_users_list()]
-            send_message(client, response)
-            return
+    def stop(self):
+        self.running = False
+        self.call_soon_threadsafe(lambda: None)
 
-        else:
-            response = ERROR_RESPONSE
-            response[ERROR] = f'Incorrect message: {message}'
-            send_message(client, response)
-            return
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, func, args = heapq.heappop(self.timers)
+            func(*args)
 
-    def _process_recv_data_list(self, data_lst):
-        for current_client in data_lst:
+    def _run_pending_callbacks(self):
+        try:
+            while self.wakeup_reader.recv(BUFFER_SIZE):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.pending_callbacks:
+            func, args = self.pending_callbacks.popleft()
             try:
-                self.process_client_message(get_message(current_client), current_client)
-            except:
-                logger.info(f'Client {current_client.getpeername()} disconnected')
-
-    def run(self) -> None:
-        self.init_server_socket()
+                func(*args)
+            except Exception as e:
+                logger.error(f'Storage callback failed: {e!r}')
+
+    def pause_reading(self, client):
+        if not client.closed:
+            client.reading_paused = True
+            self._update_interest(client)
+
+    def resume_reading(self, client):
+        if not client.closed:
+            client.reading_paused = False
+            self._update_interest(client)
+
+    def _remove_client(self, client):
+        if client.closed:
+            return
+        client.closed = True
+        if client.events:
+            self.selector.unregister(client.sock)
+        client.sock.close()
+        client.outgoing.clear()
+        client.outgoing_size = 0
+        self.client_disconnected(client)
+
+    def _accept_clients(self):
         while True:
             try:
                 client_socket, address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f'Connected with: {address}')
-                self.clients_list.append(client_socket)
-
-            recv_data_list = []
-            send_data_list = []
-
-            try:
-                recv_data_list, send_data_list, _ = select.select(self.clients_list, self.clients_list, [], 0)
-            except OSError:
-                pass
-
-            if len(recv_data_list) > 0:
-                self._process_recv_data_list(recv_data_list)
+            except (BlockingIOError, InterruptedError):
+                return
+            logger.info(f'Connected with: {address}')
+            self.metrics.accepted += 1
+            client_socket.setblocking(False)
+            self._update_interest(ClientConnection(client_socket, address))
+
+    def _read_client(self, client):
+        try:
+            for message in recv_messages(client.sock, client.reader):
+                self.process_client_message(message, client)
+                if client.closed or client.close_after_flush:
+                    break
+        except (BlockingIOError, InterruptedError):
+            pass
+        except:
+            logger.info(f'Client {client.address} disconnected')
+            self._remove_client(client)
+
+    def _write_client(self, client):
+        try:
+            while client.outgoing:
+                frame = client.outgoing[0]
+                sent = client.sock.send(frame)
+                client.outgoing_size -= sent
+                if sent < len(frame):
+                    client.outgoing[0] = memoryview(frame)[sent:]
+                    break
+                client.outgoing.popleft()
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            logger.info(f'Client {client.address} disconnected')
+            self._remove_client(client)
+            return
+        if client.congested and client.outgoing_size <= self.low_water:
+            client.congested = False
+            self.release_senders(client)
+        if not client.outgoing and client.close_after_flush:
+            self._remove_client(client)
+        else:
+            self._update_interest(client)
 
-            if len(self.messages_list) > 0 and len(send_data_list) > 0:
-                for current_message in self.messages_list:
-                    try:
-                        self.send_message_to_client(current_message, send_data_list)
-                    except Exception:
-                        self.clients_list.remove(self.clients_names[current_message[DESTINATION]])
-                        del self.clients_names[current_message[DESTINATION]]
-                self.messages_list.clear()
+    def run(self) -> None:
+        self.init_server_socket()
+        self.running = True
+        self.on_startup()
+        try:
+            self._serve()
+        finally:
+            self.on_shutdown()
+
+    def _serve(self):
+        while self.running:
+            timeout = max(0.0, self.timers[0][0] - time.monotonic()) if self.timers else None
+            for key, events in self.selector.select(timeout):
+                client = key.data
+                if key.fileobj is self.wakeup_reader:
+                    self._run_pending_callbacks()
+                    continue
+                if key.fileobj is self.sock:
+                    self._accept_clients()
+                    continue
+                if events & selectors.EVENT_READ and not client.closed and not client.reading_paused:
+                    self._read_client(client)
+                if events & selectors.EVENT_WRITE and not client.closed:
+                    self._write_client(client)
+            self._run_timers()
+
+
+# asyncio is a noticeable part of the startup, so its engine is only imported when asked for
+def get_server_engine(engine):
+    if engine == 'asyncio':
+        from async_server import GBChatAsyncServer
+        return GBChatAsyncServer
+    return GBChatServer
 
 
 class GBChatServerStarter:
@@ -188,34 +245,67 @@ class GBChatServerStarter:
     server_gui_app = None
     server_gui_window = None
     history_window = None
+    performance_window = None
     server_configuration_window = None
 
     def __init__(self):
         self.config = configparser.ConfigParser()
         dir_path = os.path.dirname(os.path.realpath(__file__))
         self.config.read(f"{dir_path}/{'server.ini'}")
-        self.listen_address, self.listen_port = parse_arguments(
-            self.config['SETTINGS']['Default_port'], self.config['SETTINGS']['Listen_Address'])
-        self.db = ServerDBStorage(
-            os.path.join(self.config['SETTINGS']['Database_path'], self.config['SETTINGS']['Database_file']))
-
-    def __get_active_users(self):
-        global new_connection
-        if new_connection:
-            self.server_gui_window.active_clients_table.setModel(get_active_users_model(self.db))
-            self.server_gui_window.active_clients_table.resizeColumnsToContents()
-            self.server_gui_window.active_clients_table.resizeRowsToContents()
-            with new_connection_lock:
-                new_connection = False
-
+        self.listen_address, self.listen_port, self.engine, self.headless = parse_arguments(
+            self.config['SETTINGS']['Default_port'], self.config['SETTINGS']['Listen_Address'],
+            self.config['SETTINGS'].get('Engine', 'threaded'), self.config['SETTINGS'].getboolean('Headless', False))
+        self.db = self.create_storage(self.config['SETTINGS'])
+
+    # Storage = memory keeps everything in process, optionally snapshotted to Snapshot_file every Snapshot_interval.
+    # Only the chosen storage is imported, so the memory storage starts without SQLAlchemy.
+    @staticmethod
+    def create_storage(settings):
+        storage = settings.get('Storage', 'sqlite')
+        if storage == 'memory':
+            from memory_storage import ServerMemoryStorage
+            snapshot_file = settings.get('Snapshot_file')
+            return ServerMemoryStorage(
+                os.path.join(settings.get('Database_path', ''), snapshot_file) if snapshot_file else None,
+                settings.getfloat('Snapshot_interval', SNAPSHOT_INTERVAL))
+        if storage != 'sqlite':
+            raise ValueError(f'Unknown storage {storage}, expected sqlite or memory')
+        from server_storage import ServerDBStorage, DB_PROFILE, DB_READERS, USER_CACHE_SIZE, CONTACTS_CACHE_SIZE
+        return ServerDBStorage(
+            os.path.join(settings['Database_path'], settings['Database_file']),
+            profile=settings.get('Db_profile', DB_PROFILE),
+            readers=settings.getint('Db_readers', DB_READERS),
+            user_cache_size=settings.getint('User_cache_size', USER_CACHE_SIZE),
+            contacts_cache_size=settings.getint('Contacts_cache_size', CONTACTS_CACHE_SIZE))
+
+    # Called with each batch of server events; only the changed rows are touched and the columns keep their width
+    def __on_server_events(self, events):
+        self.active_users_model.refresh()
+
+    # Refresh button also fits the columns to the current contents
+    def __refresh_active_users(self):
+        self.active_users_model.refresh()
+        self.server_gui_window.active_clients_table.resizeColumnsToContents()
+
+    # PyQt is imported by start_gui_server only, the GUI handlers below import from the then loaded modules
     def __show_history_window(self):
+        from PyQt5.QtCore import Qt
+        from server_gui import ServerGUIHistoryWindow, HistoryModel
         self.history_window = ServerGUIHistoryWindow()
-        self.history_window.history_table.setModel(get_history_model(self.db))
+        history_model = HistoryModel(self.db, parent=self.history_window)
+        self.history_window.history_table.setModel(history_model)
+        self.history_window.history_table.sortByColumn(0, Qt.AscendingOrder)
+        self.history_window.name_filter.textChanged.connect(history_model.set_name_filter)
         self.history_window.history_table.resizeColumnsToContents()
-        self.history_window.history_table.resizeRowsToContents()
         self.history_window.show()
 
+    def __show_performance_window(self):
+        from server_gui import ServerGUIPerformanceWindow
+        self.performance_window = ServerGUIPerformanceWindow(self.server.metrics,
+                                                             int(self.server.metrics_interval * 1000))
+
     def __show_server_config_window(self):
+        from server_gui import ServerGUIConfigWindow
         self.server_configuration_window = ServerGUIConfigWindow()
         self.server_configuration_window.db_path.insert(self.config['SETTINGS']['database_path'])
         self.server_configuration_window.db_file.insert(self.config['SETTINGS']['database_file'])
@@ -224,6 +314,7 @@ class GBChatServerStarter:
         self.server_configuration_window.save_btn.clicked.connect(self.__save_server_config)
 
     def __save_server_config(self):
+        from PyQt5.QtWidgets import QMessageBox
         message_window = QMessageBox()
         self.config['SETTINGS']['Database_path'] = self.server_configuration_window.db_path.text()
         self.config['SETTINGS']['Database_file'] = self.server_configuration_window.db_file.text()
@@ -242,22 +333,65 @@ class GBChatServerStarter:
                 message_window.warning(
                     self.server_configuration_window, 'Error', 'Port must be in range 1024 to 65536')
 
+    def create_server(self):
+        return get_server_engine(self.engine)(
+            self.listen_address, self.listen_port, self.db,
+            high_water=self.config['SETTINGS'].getint('Outbound_high_water', OUTBOUND_HIGH_WATER),
+            low_water=self.config['SETTINGS'].getint('Outbound_low_water', OUTBOUND_LOW_WATER),
+            db_workers=self.config['SETTINGS'].getint('Db_workers', 1),
+            history_flush_interval=self.config['SETTINGS'].getfloat('History_flush_interval', HISTORY_FLUSH_INTERVAL),
+            history_flush_size=self.config['SETTINGS'].getint('History_flush_size', HISTORY_FLUSH_SIZE),
+            offline_backlog_limit=self.config['SETTINGS'].getint('Offline_backlog_limit', OFFLINE_BACKLOG_LIMIT),
+            offline_message_ttl=self.config['SETTINGS'].getint('Offline_message_ttl', OFFLINE_MESSAGE_TTL),
+            login_history_max_age=self.config['SETTINGS'].getint('Login_history_max_age', LOGIN_HISTORY_MAX_AGE),
+            login_history_max_rows=self.config['SETTINGS'].getint('Login_history_max_rows', LOGIN_HISTORY_MAX_ROWS),
+            login_history_rollup_batch=self.config['SETTINGS'].getint(
+                'Login_history_rollup_batch', LOGIN_HISTORY_ROLLUP_BATCH),
+            login_history_rollup_interval=self.config['SETTINGS'].getfloat(
+                'Login_history_rollup_interval', LOGIN_HISTORY_ROLLUP_INTERVAL),
+            metrics_interval=self.config['SETTINGS'].getfloat('Metrics_interval', METRICS_INTERVAL))
+
+    # Serves in the calling thread; SIGINT or SIGTERM stop the server, which flushes its counters before returning
+    def start_headless_server(self):
+        self.server = self.create_server()
+
+        def shutdown(signum, frame):
+            logger.info(f'Received signal {signum}, stopping the server')
+            self.server.stop()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        self.server.run()
+        self.db.close()
+
     def start_gui_server(self):
-        self.server = GBChatServer(self.listen_address, self.listen_port, self.db)
+        from PyQt5.QtWidgets import QApplication
+        from server_gui import ServerGUIMainWindow, ActiveUsersModel, ServerEventBridge
+
+        self.server = self.create_server()
         self.server.start()
         self.server_gui_app = QApplication(sys.argv)
         self.server_gui_window = ServerGUIMainWindow()
         self.server_gui_window.statusBar().showMessage(f'Server is working at {self.listen_address}:{self.listen_port}')
 
-        timer = QTimer()
-        timer.timeout.connect(self.__get_active_users)
-        timer.start(1000)
+        # The server is already running, so the listener goes first: a login between the model's snapshot and the
+        # registration would otherwise not show until some later event
+        self.events_bridge = ServerEventBridge(parent=self.server_gui_window)
+        self.server.add_event_listener(self.events_bridge.post)
+        self.active_users_model = ActiveUsersModel(self.server.presence, self.server_gui_window)
+        self.events_bridge.events_ready.connect(self.__on_server_events)
+        self.server_gui_window.active_clients_table.setModel(self.active_users_model)
+        self.server_gui_window.active_clients_table.resizeColumnsToContents()
 
-        self.server_gui_window.refresh_button.triggered.connect(self.__get_active_users)
+        self.server_gui_window.refresh_button.triggered.connect(self.__refresh_active_users)
         self.server_gui_window.history_button.triggered.connect(self.__show_history_window)
+        self.server_gui_window.performance_button.triggered.connect(self.__show_performance_window)
         self.server_gui_window.settings_button.triggered.connect(self.__show_server_config_window)
 
         self.server_gui_app.exec_()
+        self.server.stop()
+        self.server.join()
+        self.db.close()
 
 
 # def main():
@@ -285,4 +419,7 @@ class GBChatServerStarter:
 
 if __name__ == '__main__':
     starter = GBChatServerStarter()
-    starter.start_gui_server()
+    if starter.headless:
+        starter.start_headless_server()
+    else:
+        starter.start_gui_server()
@@ -0,0 +1,99 @@
+import argparse
+import configparser
+import json
+import os
+import sys
+
+from gbc_common.variables import *
+from server_storage import ServerDBStorage, DB_PROFILES, DB_PROFILE, DB_READERS, IMPORT_BATCH_SIZE
+
+
+def compact(db, args):
+    size_before = db.database_size()[0]
+    rolled_up = 0
+    while True:
+        count = db.rollup_login_history(args.max_age, args.max_rows, args.batch)
+        rolled_up += count
+        if count < args.batch:
+            break
+    reclaimed = db.vacuum() if args.full else db.incremental_vacuum()
+    print(f'Rolled up {rolled_up} login history rows into daily aggregates')
+    print(f'Database size: {size_before} -> {db.database_size()[0]} bytes, reclaimed {reclaimed} bytes')
+
+
+# '-' stands for stdin or stdout, so dumps can be piped between hosts
+def open_file(path, mode):
+    if path == '-':
+        return open((sys.stdout if 'w' in mode else sys.stdin).fileno(), mode, encoding='utf-8', closefd=False)
+    return open(path, mode, encoding='utf-8')
+
+
+def export_data(db, args):
+    exported = 0
+    with open_file(args.file, 'w') as output:
+        for record in db.export_records():
+            output.write(json.dumps(record, ensure_ascii=False))
+            output.write('\n')
+            exported += 1
+    print(f'Exported {exported} records', file=sys.stderr)
+
+
+def import_data(db, args):
+    with open_file(args.file, 'r') as source:
+        imported = db.import_records((json.loads(line) for line in source if line.strip()), args.batch)
+    print(', '.join(f'{count} {kind} records' for kind, count in imported.items()) + ' imported', file=sys.stderr)
+
+
+# A batch below one row would never finish a compaction
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive number')
+    return number
+
+
+def parse_arguments(settings):
+    parser = argparse.ArgumentParser(description='GB Chat server database maintenance')
+    parser.add_argument('-d', '--database', default=os.path.join(
+        settings.get('Database_path', ''), settings.get('Database_file', 'server_db.sqlite')))
+    parser.add_argument('--profile', default=settings.get('Db_profile', DB_PROFILE), choices=DB_PROFILES,
+                        help='SQLite pragma profile, fast speeds up large imports')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = commands.add_parser('compact', help='roll up old login history and reclaim free space')
+    compact_parser.add_argument('--max-age', default=settings.getint('Login_history_max_age', LOGIN_HISTORY_MAX_AGE),
+                                type=int, help='days of raw login history to keep, 0 to keep all')
+    compact_parser.add_argument('--max-rows', default=settings.getint(
+        'Login_history_max_rows', LOGIN_HISTORY_MAX_ROWS), type=int, help='raw login rows to keep, 0 to keep all')
+    compact_parser.add_argument('--batch', default=settings.getint(
+        'Login_history_rollup_batch', LOGIN_HISTORY_ROLLUP_BATCH), type=positive_int)
+    compact_parser.add_argument('--full', action='store_true', help='rebuild the whole file with VACUUM')
+    compact_parser.set_defaults(handler=compact)
+
+    export_parser = commands.add_parser('export',
+                                        help='dump users, contacts, login history and daily logins as JSON Lines')
+    export_parser.add_argument('file', nargs='?', default='-')
+    export_parser.set_defaults(handler=export_data)
+
+    import_parser = commands.add_parser('import', help='merge a JSON Lines dump, creating the database if needed')
+    import_parser.add_argument('file', nargs='?', default='-')
+    import_parser.add_argument('--batch', default=IMPORT_BATCH_SIZE, type=positive_int, help='records per transaction')
+    import_parser.set_defaults(handler=import_data)
+    return parser.parse_args()
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'server.ini'))
+    settings = config['SETTINGS'] if config.has_section('SETTINGS') else config['DEFAULT']
+    args = parse_arguments(settings)
+    if args.command != 'import' and not os.path.exists(args.database):
+        print(f'Database {args.database} not found')
+        sys.exit(1)
+    db = ServerDBStorage(args.database, profile=args.profile, readers=settings.getint('Db_readers', DB_READERS))
+    args.handler(db, args)
+    db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+import base64
+import binascii
+import logging
+from collections import defaultdict
+from threading import Thread
+
+from descrs import PortDescriptor
+from gbc_common.util import encode_message
+from gbc_common.variables import *
+from presence import PresenceRegistry, PresenceEvent, LOGIN_EVENT, LOGOUT_EVENT, STATS_EVENT
+from server_metrics import ServerMetrics, process_rss
+from storage_executor import StorageExecutor
+
+logger = logging.getLogger('server_logger')
+
+
+# Cursors are opaque to clients: the last name of the previous page, base64 encoded
+def encode_cursor(name):
+    return base64.urlsafe_b64encode(name.encode(ENCODING)).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.b64decode(cursor.encode('ascii'), altchars=b'-_', validate=True).decode(ENCODING)
+    except (binascii.Error, UnicodeError, AttributeError):
+        raise ValueError(f'Incorrect cursor {cursor}')
+
+
+class BaseClientConnection:
+    def __init__(self, address=None):
+        self.address = address
+        self.name = None
+        # Set while the outbound queue is above the high water mark and not yet drained below the low one
+        self.congested = False
+        # Senders paused because of this recipient, and recipients this sender is paused by
+        self.blocked_senders = set()
+        self.blocking_recipients = set()
+        # Live messages are held back until the stored offline backlog has been delivered
+        self.backlog_pending = False
+        self.held_messages = []
+
+
+class GBChatBaseServer(Thread):
+    port = PortDescriptor()
+
+    def __init__(self, listen_address, listen_port, storage, high_water=OUTBOUND_HIGH_WATER,
+                 low_water=OUTBOUND_LOW_WATER, db_workers=1, history_flush_interval=HISTORY_FLUSH_INTERVAL,
+                 history_flush_size=HISTORY_FLUSH_SIZE, offline_backlog_limit=OFFLINE_BACKLOG_LIMIT,
+                 offline_message_ttl=OFFLINE_MESSAGE_TTL, login_history_max_age=LOGIN_HISTORY_MAX_AGE,
+                 login_history_max_rows=LOGIN_HISTORY_MAX_ROWS, login_history_rollup_batch=LOGIN_HISTORY_ROLLUP_BATCH,
+                 login_history_rollup_interval=LOGIN_HISTORY_ROLLUP_INTERVAL, metrics_interval=METRICS_INTERVAL):
+        super().__init__()
+        self.daemon = True
+        self.address = listen_address
+        self.port = listen_port
+        self.high_water = high_water
+        self.low_water = low_water
+        self.clients_names = {}
+        # Who is online is only kept here; the storage records the login history
+        self.presence = PresenceRegistry()
+        # Callables taking a PresenceEvent, called from the server thread
+        self.event_listeners = []
+        self.stats_event_scheduled = False
+        # Group name to the set of member names, mirrored from storage for O(1) membership checks
+        self.groups = {}
+        self.storage = storage
+        self.storage_executor = StorageExecutor(db_workers)
+        self.history_flush_interval = history_flush_interval
+        self.history_flush_size = history_flush_size
+        # Delivered message counters waiting to be written: {user_name: [sent, received]}
+        self.pending_counters = defaultdict(lambda: [0, 0])
+        self.pending_messages_count = 0
+        self.offline_backlog_limit = offline_backlog_limit
+        self.offline_message_ttl = offline_message_ttl
+        self.login_history_max_age = login_history_max_age
+        self.login_history_max_rows = login_history_max_rows
+        self.login_history_rollup_batch = login_history_rollup_batch
+        self.login_history_rollup_interval = login_history_rollup_interval
+        self.metrics = ServerMetrics()
+        self.metrics_interval = metrics_interval
+        self.sock = None
+
+    def add_event_listener(self, listener):
+        self.event_listeners.append(listener)
+
+    def emit_event(self, kind, name):
+        if self.event_listeners:
+            event = PresenceEvent(kind, name)
+            for listener in self.event_listeners:
+                listener(event)
+
+    # Counters change on every routed message, so listeners get at most one stats event per STATS_EVENT_INTERVAL
+    def counters_changed(self):
+        if self.event_listeners and not self.stats_event_scheduled:
+            self.stats_event_scheduled = True
+            self.call_later(STATS_EVENT_INTERVAL, self.emit_stats_event)
+
+    def emit_stats_event(self):
+        self.stats_event_scheduled = False
+        self.emit_event(STATS_EVENT, None)
+
+    def enqueue_frame(self, client, frame):
+        raise NotImplementedError
+
+    def enqueue_message(self, client, message):
+        self.enqueue_frame(client, encode_message(message))
+
+    def send_response(self, client, request, response):
+        if REQUEST_ID in request:
+            response = {**response, REQUEST_ID: request[REQUEST_ID]}
+        self.enqueue_message(client, response)
+
+    def close_client(self, client):
+        raise NotImplementedError
+
+    # Bytes queued for sending to all clients
+    def outbound_queue_size(self):
+        raise NotImplementedError
+
+    def call_soon_threadsafe(self, func, *args):
+        raise NotImplementedError
+
+    def call_later(self, delay, func, *args):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    def on_startup(self):
+        self.call_storage(lambda deleted: logger.info(f'Purged {deleted} expired offline messages'),
+                          self.storage.purge_offline_messages, self.offline_message_ttl)
+        self.call_storage(self.load_groups, self.storage.group_members_list)
+        if self.login_history_max_age or self.login_history_max_rows:
+            self.call_later(self.login_history_rollup_interval, self.rollup_login_history)
+        self.call_later(self.metrics_interval, self.sample_metrics)
+
+    def sample_metrics(self):
+        self.call_later(self.metrics_interval, self.sample_metrics)
+        self.metrics.sample(self.outbound_queue_size(), self.storage_executor.latency_percentiles(), process_rss())
+
+    # Old login rows are rolled up one batch per storage call, so routing calls queue between the batches
+    def rollup_login_history(self, rolled_up=0):
+        def on_batch(count):
+            if count == self.login_history_rollup_batch:
+                self.rollup_login_history(rolled_up + count)
+            elif rolled_up + count:
+                logger.info(f'Rolled up {rolled_up + count} login history rows into daily aggregates')
+                self.call_storage(lambda reclaimed: logger.info(f'Incremental vacuum reclaimed {reclaimed} bytes'),
+                                  self.storage.incremental_vacuum, VACUUM_PAGES)
+
+        if not rolled_up:
+            self.call_later(self.login_history_rollup_interval, self.rollup_login_history)
+        self.call_storage(on_batch, self.storage.rollup_login_history, self.login_history_max_age,
+                          self.login_history_max_rows, self.login_history_rollup_batch)
+
+    def load_groups(self, members):
+        for group_name, user_name in members:
+            self.groups.setdefault(group_name, set()).add(user_name)
+        logger.info(f'Loaded {len(self.groups)} groups')
+
+    def on_shutdown(self):
+        counters, self.pending_counters = self.pending_counters, defaultdict(lambda: [0, 0])
+        self.storage_executor.submit(self.storage.message_history_bulk_update, dict(counters))
+        self.storage_executor.shutdown(wait=True)
+        logger.info(f'Server stopped. Storage stats: {self.storage_executor.stats()}, {self.storage.stats()}')
+
+    def pause_reading(self, client):
+        raise NotImplementedError
+
+    def resume_reading(self, client):
+        raise NotImplementedError
+
+    def call_storage(self, callback, func, *args, on_error=None):
+        future = self.storage_executor.submit(func, *args)
+        future.add_done_callback(
+            lambda done: self.call_soon_threadsafe(self._storage_call_done, callback, on_error, done))
+
+    # Storage call answering a client request: a failure is answered with an error, so the client is not left
+    # waiting for its request id until the timeout
+    def call_storage_for(self, client, request, callback, func, *args):
+        self.call_storage(callback, func, *args, on_error=lambda error: self.send_response(
+            client, request, {**ERROR_RESPONSE, ERROR: f'Storage error: {error}'}))
+
+    @staticmethod
+    def _storage_call_done(callback, on_error, future):
+        if future.exception() is not None:
+            logger.error(f'Storage call failed: {future.exception()!r}')
+            if on_error is not None:
+                on_error(future.exception())
+        elif callback is not None:
+            callback(future.result())
+
+    def client_disconnected(self, client):
+        self.metrics.disconnected += 1
+        self.release_senders(client)
+        for recipient in client.blocking_recipients:
+            recipient.blocked_senders.discard(client)
+        client.blocking_recipients.clear()
+        if client.name is not None and self.clients_names.get(client.name) is client:
+            del self.clients_names[client.name]
+            if client.held_messages:
+                self.store_offline_messages(client.name, client.held_messages)
+                client.held_messages = []
+            self.presence.logout(client.name)
+            self.emit_event(LOGOUT_EVENT, client.name)
+
+    def block_sender(self, sender, recipient):
+        if sender is recipient or sender in recipient.blocked_senders:
+            return
+        recipient.blocked_senders.add(sender)
+        sender.blocking_recipients.add(recipient)
+        if len(sender.blocking_recipients) == 1:
+            logger.debug(f'Pausing {sender.name}: {recipient.name} is congested')
+            self.pause_reading(sender)
+
+    def release_senders(self, recipient):
+        for sender in recipient.blocked_senders:
+            sender.blocking_recipients.discard(recipient)
+            if not sender.blocking_recipients:
+                self.resume_reading(sender)
+        recipient.blocked_senders.clear()
+
+    def store_offline_messages(self, user_name, messages):
+        def on_stored(stored):
+            if not stored:
+                logger.error(f'Cannot send message to {user_name}')
+
+        self.call_storage(on_stored, self.storage.store_offline_messages, user_name, messages,
+                          self.offline_backlog_limit)
+
+    def deliver_backlog(self, client, backlog):
+        client.backlog_pending = False
+        messages, client.held_messages = backlog + client.held_messages, []
+        if self.clients_names.get(client.name) is not client:
+            if messages:
+                self.store_offline_messages(client.name, messages)
+            return
+        if backlog:
+            logger.info(f'Delivering {len(backlog)} stored messages to {client.name}')
+        for message in messages:
+            self.enqueue_message(client, message)
+            self.count_delivered_message(message[SENDER], message[DESTINATION])
+
+    def send_message_to_client(self, message, sender):
+        if message[DESTINATION] not in self.clients_names:
+            self.store_offline_messages(message[DESTINATION], [message])
+            return False
+        recipient = self.clients_names[message[DESTINATION]]
+        if recipient.backlog_pending:
+            recipient.held_messages.append(message)
+            return True
+        self.enqueue_message(recipient, message)
+        if recipient.congested:
+            self.block_sender(sender, recipient)
+        self.count_delivered_message(message[SENDER], message[DESTINATION])
+        return True
+
+    def send_message_to_group(self, message, sender):
+        members = self.groups.get(message[GROUP_NAME])
+        if members is None or message[SENDER] not in members:
+            return False
+        # The post is encoded once and the same frame is queued for every online member
+        frame = encode_message(message)
+        recipients = []
+        for member in members:
+            recipient = self.clients_names.get(member)
+            if recipient is None or recipient is sender:
+                continue
+            self.enqueue_frame(recipient, frame)
+            if recipient.congested:
+                self.block_sender(sender, recipient)
+            recipients.append(member)
+        self.count_group_message(message[SENDER], recipients)
+        return True
+
+    def count_group_message(self, sender, recipients):
+        self.presence.count_message(sender, recipients)
+        self.counters_changed()
+        self.metrics.messages += 1
+        self.pending_counters[sender][0] += 1
+        for recipient in recipients:
+            self.pending_counters[recipient][1] += 1
+        self.count_pending_messages()
+
+    def count_delivered_message(self, sender, recipient):
+        self.presence.count_message(sender, (recipient,))
+        self.counters_changed()
+        self.metrics.messages += 1
+        self.pending_counters[sender][0] += 1
+        self.pending_counters[recipient][1] += 1
+        self.count_pending_messages()
+
+    def count_pending_messages(self):
+        self.pending_messages_count += 1
+        if self.pending_messages_count >= self.history_flush_size:
+            self.flush_message_counters()
+        elif self.pending_messages_count == 1:
+            self.call_later(self.history_flush_interval, self.flush_message_counters)
+
+    def flush_message_counters(self):
+        if not self.pending_counters:
+            return
+        counters, self.pending_counters = self.pending_counters, defaultdict(lambda: [0, 0])
+        self.pending_messages_count = 0
+        self.call_storage(None, self.storage.message_history_bulk_update, dict(counters))
+
+    def process_client_message(self, message: dict, client):
+        logger.debug(f'Processing message from client: {message}')
+        self.metrics.requests += 1
+
+        # Process PRESENCE message
+        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+            if message[USER][ACCOUNT_NAME] not in self.clients_names:
+                self.clients_names[message[USER][ACCOUNT_NAME]] = client
+                client.name = message[USER][ACCOUNT_NAME]
+                client.backlog_pending = True
+                address, port = client.address
+                self.send_response(client, message, OK_RESPONSE)
+                self.presence.login(client.name, address, port)
+                self.emit_event(LOGIN_EVENT, client.name)
+                self.call_storage(None, self.storage.login_user, client.name, address, port)
+                self.call_storage(lambda backlog: self.deliver_backlog(client, backlog),
+                                  self.storage.pop_offline_messages, client.name, self.offline_message_ttl)
+            else:
+                response = ERROR_RESPONSE
+                response[ERROR] = f'Name {message[USER][ACCOUNT_NAME]} is already taken'
+                self.send_response(client, message, response)
+                self.close_client(client)
+            return
+
+        # Process MESSAGE message
+        elif ACTION in message and message[ACTION] == MESSAGE and TIME in message and MESSAGE_TEXT in message and \
+                SENDER in message and DESTINATION in message:
+            self.send_message_to_client(message, client)
+            return
+
+        # Process GROUP_MESSAGE message
+        elif ACTION in message and message[ACTION] == GROUP_MESSAGE and TIME in message and MESSAGE_TEXT in message \
+                and SENDER in message and GROUP_NAME in message and self.clients_names[message[SENDER]] == client:
+            if not self.send_message_to_group(message, client):
+                self.send_response(client, message, {**ERROR_RESPONSE, ERROR: f'Not a member of {message[GROUP_NAME]}'})
+            return
+
+        # Process GROUP_CREATE message
+        elif ACTION in message and message[ACTION] == GROUP_CREATE and GROUP_NAME in message and USER in message \
+                and self.clients_names[message[USER]] == client:
+            if message[GROUP_NAME] in self.groups:
+                self.send_response(client, message,
+                                   {**ERROR_RESPONSE, ERROR: f'Group {message[GROUP_NAME]} already exists'})
+                return
+            self.groups[message[GROUP_NAME]] = {message[USER]}
+
+            def on_group_created(created):
+                if created:
+                    self.send_response(client, message, OK_RESPONSE)
+                else:
+                    self.groups.pop(message[GROUP_NAME], None)
+                    self.send_response(client, message,
+                                       {**ERROR_RESPONSE, ERROR: f'Cannot create {message[GROUP_NAME]}'})
+
+            self.call_storage(on_group_created, self.storage.create_group, message[USER], message[GROUP_NAME],
+                              on_error=lambda _: on_group_created(False))
+            return
+
+        # Process GROUP_JOIN message
+        elif ACTION in message and message[ACTION] == GROUP_JOIN and GROUP_NAME in message and USER in message \
+                and self.clients_names[message[USER]] == client:
+            if message[GROUP_NAME] not in self.groups:
+                self.send_response(client, message, {**ERROR_RESPONSE, ERROR: f'No group {message[GROUP_NAME]}'})
+                return
+
+            # Fan-out follows the database, so the member is added only once the storage has recorded it
+            def on_joined(joined):
+                if joined:
+                    self.groups.setdefault(message[GROUP_NAME], set()).add(message[USER])
+                    self.send_response(client, message, OK_RESPONSE)
+                else:
+                    self.send_response(client, message,
+                                       {**ERROR_RESPONSE, ERROR: f'Cannot join {message[GROUP_NAME]}'})
+
+            self.call_storage_for(client, message, on_joined, self.storage.join_group, message[USER],
+                                  message[GROUP_NAME])
+            return
+
+        # Process GROUP_LEAVE message
+        elif ACTION in message and message[ACTION] == GROUP_LEAVE and GROUP_NAME in message and USER in message \
+                and self.clients_names[message[USER]] == client:
+            self.groups.get(message[GROUP_NAME], set()).discard(message[USER])
+            self.call_storage_for(client, message, lambda _: self.send_response(client, message, OK_RESPONSE),
+                                  self.storage.leave_group, message[USER], message[GROUP_NAME])
+            return
+
+        # Process EXIT message
+        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message:
+            self.close_client(self.clients_names[message[ACCOUNT_NAME]])
+            return
+
+        # Process GET_CONTACTS message
+        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
+                self.clients_names[message[USER]] == client:
+            self.call_storage_for(
+                client, message,
+                lambda contacts: self.send_response(client, message, {**ACCEPTED_RESPONSE, LIST_INFO: contacts}),
+                self.storage.get_all_contacts, message[USER])
+            return
+
+        # Process batch ADD_CONTACT and REMOVE_CONTACT messages, answered with the result for every name
+        elif ACTION in message and message[ACTION] in (ADD_CONTACT, REMOVE_CONTACT) and ACCOUNT_NAMES in message \
+                and USER in message and self.clients_names[message[USER]] == client:
+            names = message[ACCOUNT_NAMES]
+            if not isinstance(names, list) or len(names) > MAX_CONTACTS_BATCH \
+                    or not all(isinstance(name, str) for name in names):
+                self.send_response(client, message, {**ERROR_RESPONSE, ERROR: 'Incorrect contacts list'})
+                return
+            storage_call = self.storage.add_contacts if message[ACTION] == ADD_CONTACT else self.storage.delete_contacts
+            self.call_storage_for(
+                client, message,
+                lambda results: self.send_response(client, message, {**ACCEPTED_RESPONSE, LIST_INFO: results}),
+                storage_call, message[USER], names)
+            return
+
+        # Process ADD_CONTACT message
+        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
+                and self.clients_names[message[USER]] == client:
+            self.call_storage_for(client, message, lambda _: self.send_response(client, message, OK_RESPONSE),
+                                  self.storage.add_contact, message[USER], message[ACCOUNT_NAME])
+            return
+
+        # Process REMOVE_CONTACT message
+        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
+                and self.clients_names[message[USER]] == client:
+            self.call_storage_for(client, message, lambda _: self.send_response(client, message, OK_RESPONSE),
+                                  self.storage.delete_contact, message[USER], message[ACCOUNT_NAME])
+            return
+
+        # Process paged USERS_REQUEST message
+        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+                and PAGE_SIZE in message and self.clients_names[message[ACCOUNT_NAME]] == client:
+            try:
+                page_size = max(1, min(int(message[PAGE_SIZE]), MAX_PAGE_SIZE))
+                after_name = decode_cursor(message[CURSOR]) if message.get(CURSOR) else None
+            except (TypeError, ValueError):
+                self.send_response(client, message, {**ERROR_RESPONSE, ERROR: 'Incorrect page request'})
+                return
+
+            def on_page(page):
+                names, has_more = page
+                self.send_response(client, message, {**ACCEPTED_RESPONSE, LIST_INFO: names,
+                                                     NEXT_CURSOR: encode_cursor(names[-1]) if has_more else None})
+
+            self.call_storage_for(client, message, on_page, self.storage.users_page, page_size, after_name,
+                                  message.get(NAME_PREFIX))
+            return
+
+        # Process USERS_REQUEST message
+        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+                and self.clients_names[message[ACCOUNT_NAME]] == client:
+            self.call_storage_for(
+                client, message, lambda users: self.send_response(
+                    client, message, {**ACCEPTED_RESPONSE, LIST_INFO: [row[0] for row in users]}),
+                self.storage.all_users_list)
+            return
+
+        # Process SYNC_REQUEST message
+        elif ACTION in message and message[ACTION] == SYNC_REQUEST and ACCOUNT_NAME in message \
+                and SINCE_VERSION in message and self.clients_names[message[ACCOUNT_NAME]] == client:
+            def on_changes(changes):
+                version, full, users_added, contacts_added, contacts_removed = changes
+                self.send_response(client, message, {**ACCEPTED_RESPONSE, LIST_INFO: {
+                    SYNC_VERSION: version,
+                    SYNC_FULL: full,
+                    USERS_ADDED: users_added,
+                    CONTACTS_ADDED: contacts_added,
+                    CONTACTS_REMOVED: contacts_removed,
+                }})
+
+            self.call_storage_for(client, message, on_changes, self.storage.get_changes, message[ACCOUNT_NAME],
+                                  message[SINCE_VERSION])
+            return
+
+        else:
+            response = ERROR_RESPONSE
+            response[ERROR] = f'Incorrect message: {message}'
+            self.send_response(client, message, response)
+            return
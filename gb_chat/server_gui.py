@@ -1,52 +1,206 @@
+import datetime
 import sys
 import threading
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QObject, QTimer, pyqtSignal
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from PyQt5.QtWidgets import QMainWindow, QAction, qApp, QLabel, QTableView, QApplication, QDialog, QPushButton, \
     QLineEdit, QFileDialog
 
-from server_storage import ServerDBStorage
-
-
-db_lock = threading.Lock()
-
-
-def get_active_users_model(db: ServerDBStorage) -> QStandardItemModel:
-    result = QStandardItemModel()
-    result.setHorizontalHeaderLabels(['Client name', 'IP address', 'Port', 'Date'])
-    with db_lock:
-        query = db.current_users_list()
-    for name, ip, port, date in query:
-        user = QStandardItem(name)
-        user_ip = QStandardItem(ip)
-        user_port = QStandardItem(port)
-        user_date = QStandardItem(str(date.replace(microsecond=0)))
-        user.setEditable(False)
-        user_ip.setEditable(False)
-        user_port.setEditable(False)
-        user_date.setEditable(False)
-        result.appendRow([user, user_ip, user_port, user_date])
-    return result
-
-
-def get_history_model(db: ServerDBStorage) -> QStandardItemModel:
-    result = QStandardItemModel()
-    result.setHorizontalHeaderLabels(['Client name', 'Last login', 'Messages sent', 'Messages received'])
-    with db_lock:
-        query = db.message_history_list()
-    for entry in query:
-        user, date, sent, received = entry
-        user_item = QStandardItem(user)
-        date_item = QStandardItem(str(date.replace(microsecond=0)))
-        sent_item = QStandardItem(str(sent))
-        received_item = QStandardItem(str(received))
-        user_item.setEditable(False)
-        date_item.setEditable(False)
-        sent_item.setEditable(False)
-        received_item.setEditable(False)
-        result.appendRow([user_item, date_item, sent_item, received_item])
-    return result
+from presence import PresenceRegistry
+from server_metrics import ServerMetrics
+from storage_base import BaseServerStorage
+
+
+HISTORY_PAGE_SIZE = 200
+# Milliseconds during which server events after a delivered batch are collected into the next one
+EVENTS_WINDOW = 50
+
+
+def display_value(value):
+    if isinstance(value, datetime.datetime):
+        return str(value.replace(microsecond=0))
+    return str(value)
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:.0f} {unit}'
+        size /= 1024
+    return f'{size:.1f} GB'
+
+
+# Hands server events over to the GUI thread. The first event after a quiet period is delivered at once through
+# a queued signal; events arriving within the window after a delivery are held and delivered as one batch.
+# Repeated events collapse, so a batch holds each (kind, name) pair once however busy the server is.
+class ServerEventBridge(QObject):
+    events_ready = pyqtSignal(list)
+    wakeup = pyqtSignal()
+
+    def __init__(self, window=EVENTS_WINDOW, parent=None):
+        super().__init__(parent)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.scheduled = False
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(window)
+        self.timer.timeout.connect(self.deliver)
+        self.wakeup.connect(self.deliver, Qt.QueuedConnection)
+
+    # Server event listener, safe to call from any thread
+    def post(self, event):
+        with self.lock:
+            self.pending.add(event)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        self.wakeup.emit()
+
+    def deliver(self):
+        with self.lock:
+            events, self.pending = self.pending, set()
+            if not events:
+                self.scheduled = False
+                return
+        self.timer.start()
+        self.events_ready.emit(list(events))
+
+
+# Mirrors the presence registry row by row: refresh applies only what changed since the last seen version
+class ActiveUsersModel(QAbstractTableModel):
+    headers = ['Client name', 'IP address', 'Port', 'Date', 'Sent', 'Received']
+
+    def __init__(self, presence: PresenceRegistry, parent=None):
+        super().__init__(parent)
+        self.presence = presence
+        self.version, self.rows = presence.snapshot()
+        self.row_numbers = {entry.name: number for number, entry in enumerate(self.rows)}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return display_value(self.rows[index.row()][index.column()])
+
+    # Returns True if any row was added or removed
+    def refresh(self):
+        if self.presence.version == self.version:
+            return False
+        self.version, full, changed, removed = self.presence.diff(self.version)
+        if full:
+            self.beginResetModel()
+            self.rows = changed
+            self.row_numbers = {entry.name: number for number, entry in enumerate(self.rows)}
+            self.endResetModel()
+            return True
+
+        # Removed rows go in runs of adjacent rows, from the bottom up so that earlier row numbers stay valid
+        removed_rows = sorted((self.row_numbers[name] for name in removed if name in self.row_numbers), reverse=True)
+        rows_removed = bool(removed_rows)
+        while removed_rows:
+            last = first = removed_rows.pop(0)
+            while removed_rows and removed_rows[0] == first - 1:
+                first = removed_rows.pop(0)
+            self.beginRemoveRows(QModelIndex(), first, last)
+            del self.rows[first:last + 1]
+            self.endRemoveRows()
+        if rows_removed:
+            self.row_numbers = {entry.name: number for number, entry in enumerate(self.rows)}
+
+        updated_rows = []
+        added = []
+        for entry in changed:
+            number = self.row_numbers.get(entry.name)
+            if number is None:
+                added.append(entry)
+            else:
+                self.rows[number] = entry
+                updated_rows.append(number)
+        if updated_rows:
+            self.dataChanged.emit(self.index(min(updated_rows), 0),
+                                  self.index(max(updated_rows), len(self.headers) - 1))
+        if added:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(added) - 1)
+            for entry in added:
+                self.row_numbers[entry.name] = len(self.rows)
+                self.rows.append(entry)
+            self.endInsertRows()
+        return rows_removed or bool(added)
+
+
+# Pulls message history a page at a time as the view scrolls; sorting and the name filter are done by the storage
+class HistoryModel(QAbstractTableModel):
+    headers = ['Client name', 'Last login', 'Messages sent', 'Messages received']
+
+    def __init__(self, db: BaseServerStorage, page_size=HISTORY_PAGE_SIZE, parent=None):
+        super().__init__(parent)
+        self.db = db
+        self.page_size = page_size
+        self.sort_column = 0
+        self.descending = False
+        self.name_filter = None
+        self.rows = []
+        self.cursor = None
+        self.has_more = True
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        return display_value(self.rows[index.row()][index.column()])
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.has_more
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        rows, self.cursor = self.db.message_history_page(self.page_size, self.sort_column, self.descending,
+                                                         self.cursor, self.name_filter)
+        self.has_more = self.cursor is not None
+        if rows:
+            self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+
+    # Drops the loaded rows, the view then fetches the first page again
+    def restart(self):
+        self.beginResetModel()
+        self.rows = []
+        self.cursor = None
+        self.has_more = True
+        self.endResetModel()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.descending = order == Qt.DescendingOrder
+        self.restart()
+
+    def set_name_filter(self, name_filter):
+        self.name_filter = name_filter or None
+        self.restart()
 
 
 class ServerGUIMainWindow(QMainWindow):
@@ -58,6 +212,7 @@ class ServerGUIMainWindow(QMainWindow):
 
         self.refresh_button = QAction('Refresh list', self)
         self.history_button = QAction('Users history', self)
+        self.performance_button = QAction('Performance', self)
         self.settings_button = QAction('Server settings', self)
 
         self.statusBar()
@@ -66,6 +221,7 @@ class ServerGUIMainWindow(QMainWindow):
         self.toolbar.addAction(self.exit_action)
         self.toolbar.addAction(self.refresh_button)
         self.toolbar.addAction(self.history_button)
+        self.toolbar.addAction(self.performance_button)
         self.toolbar.addAction(self.settings_button)
 
         self.setFixedSize(800, 600)
@@ -93,12 +249,88 @@ class ServerGUIHistoryWindow(QDialog):
         self.close_button.move(250, 650)
         self.close_button.clicked.connect(self.close)
 
+        self.name_filter_label = QLabel('Name contains:', self)
+        self.name_filter_label.move(10, 13)
+        self.name_filter_label.setFixedSize(120, 15)
+
+        self.name_filter = QLineEdit(self)
+        self.name_filter.move(130, 10)
+        self.name_filter.setFixedSize(460, 20)
+
         self.history_table = QTableView(self)
-        self.history_table.move(10, 10)
-        self.history_table.setFixedSize(580, 620)
+        self.history_table.move(10, 40)
+        self.history_table.setFixedSize(580, 590)
+        self.history_table.setSortingEnabled(True)
+
+        self.show()
+
+
+# Latest, average and peak of every metric over the samples kept by the server
+class ServerGUIPerformanceWindow(QDialog):
+    rows = [
+        ('Messages per second', 'messages_rate', lambda value: f'{value:.1f}'),
+        ('Requests per second', 'requests_rate', lambda value: f'{value:.1f}'),
+        ('Connections', 'connections', lambda value: f'{value:.0f}'),
+        ('Accepts per second', 'accept_rate', lambda value: f'{value:.1f}'),
+        ('Outbound queue', 'outbound_bytes', format_size),
+        ('DB call latency p50', 'db_p50', lambda value: f'{value * 1000:.2f} ms'),
+        ('DB call latency p95', 'db_p95', lambda value: f'{value * 1000:.2f} ms'),
+        ('DB call latency p99', 'db_p99', lambda value: f'{value * 1000:.2f} ms'),
+        ('Process RSS', 'rss', format_size),
+    ]
+
+    def __init__(self, metrics: ServerMetrics, interval=1000):
+        super().__init__()
+        self.metrics = metrics
+        self.setWindowTitle('Performance')
+        self.setFixedSize(560, 330)
+        self.setAttribute(Qt.WA_DeleteOnClose)
+
+        self.samples_label = QLabel(self)
+        self.samples_label.move(10, 10)
+        self.samples_label.setFixedSize(230, 15)
+
+        for number, title in enumerate(('Current', 'Average', 'Peak')):
+            header = QLabel(title, self)
+            header.move(250 + number * 100, 10)
+            header.setFixedSize(90, 15)
+            header.setAlignment(Qt.AlignRight)
+
+        self.value_labels = []
+        for row_number, (title, _, _) in enumerate(self.rows):
+            title_label = QLabel(title, self)
+            title_label.move(10, 40 + row_number * 25)
+            title_label.setFixedSize(230, 15)
+            labels = []
+            for number in range(3):
+                label = QLabel('-', self)
+                label.move(250 + number * 100, 40 + row_number * 25)
+                label.setFixedSize(90, 15)
+                label.setAlignment(Qt.AlignRight)
+                labels.append(label)
+            self.value_labels.append(labels)
+
+        self.close_button = QPushButton('Close', self)
+        self.close_button.move(240, 290)
+        self.close_button.clicked.connect(self.close)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.update_values)
+        self.timer.start(interval)
+        self.update_values()
 
         self.show()
 
+    def update_values(self):
+        samples = self.metrics.history()
+        self.samples_label.setText(f'Last {len(samples)} samples')
+        for (_, field, formatter), labels in zip(self.rows, self.value_labels):
+            values = [getattr(sample, field) for sample in samples if getattr(sample, field) is not None]
+            if not values:
+                continue
+            for label, value in zip(labels, (values[-1], sum(values) / len(values), max(values))):
+                label.setText(formatter(value))
+
 
 class ServerGUIConfigWindow(QDialog):
     def __init__(self):
@@ -0,0 +1,62 @@
+import os
+import sys
+import time
+from collections import deque, namedtuple
+from threading import Lock
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from gbc_common.variables import METRICS_SAMPLES
+
+# Rates are per second over the interval since the previous sample, latencies are in seconds, sizes in bytes
+MetricsSample = namedtuple('MetricsSample', [
+    'time', 'messages_rate', 'requests_rate', 'connections', 'accept_rate', 'outbound_bytes',
+    'db_p50', 'db_p95', 'db_p99', 'rss'])
+
+
+# Current resident set size; where /proc is missing the peak size is the best available, and None without either
+def process_rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+# Counters are only touched by the server thread, which also takes the samples; the ring buffer of samples
+# is what other threads read
+class ServerMetrics:
+    def __init__(self, samples=METRICS_SAMPLES):
+        self.lock = Lock()
+        self.samples = deque(maxlen=samples)
+        self.messages = 0
+        self.requests = 0
+        self.accepted = 0
+        self.disconnected = 0
+        self.last_time = time.monotonic()
+        self.last_counts = (0, 0, 0)
+
+    def sample(self, outbound_bytes, db_latencies, rss):
+        now = time.monotonic()
+        elapsed = max(now - self.last_time, 1e-6)
+        counts = (self.messages, self.requests, self.accepted)
+        messages_rate, requests_rate, accept_rate = ((count - last) / elapsed
+                                                     for count, last in zip(counts, self.last_counts))
+        self.last_time, self.last_counts = now, counts
+        sample = MetricsSample(time.time(), messages_rate, requests_rate, self.accepted - self.disconnected,
+                               accept_rate, outbound_bytes, *db_latencies, rss)
+        with self.lock:
+            self.samples.append(sample)
+        return sample
+
+    # Oldest first
+    def history(self):
+        with self.lock:
+            return list(self.samples)
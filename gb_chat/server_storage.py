@@ -1,13 +1,62 @@
 import datetime
+import json
+import logging
 from pprint import pprint
 
-from sqlalchemy import create_engine, Table, Column, Integer, String, DateTime, ForeignKey, MetaData
+from sqlalchemy import create_engine, Table, Column, Integer, String, DateTime, ForeignKey, MetaData, Text, Index, \
+    UniqueConstraint, Boolean, Date, select, bindparam, func, or_, exists, inspect, literal, event, text, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy.pool import QueuePool
 
-RECYCLE_PERIOD = 7200
+from gbc_common.variables import CONTACT_ADDED, CONTACT_REMOVED, CONTACT_UNCHANGED, CONTACT_UNKNOWN
+from storage_base import BaseServerStorage
+from storage_cache import LRUCache
+
+logger = logging.getLogger('server_logger')
 
+RECYCLE_PERIOD = 7200
 
-class ServerDBStorage:
+# SQLite pragmas applied to every connection; cache_size is negative to be read as KiB
+DB_PROFILES = {
+    'durable': {'journal_mode': 'WAL', 'synchronous': 'FULL', 'cache_size': -8000, 'temp_store': 'MEMORY'},
+    'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -16000, 'temp_store': 'MEMORY'},
+    'fast': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -64000, 'temp_store': 'MEMORY'},
+}
+DB_PROFILE = 'balanced'
+DB_READERS = 2
+USER_CACHE_SIZE = 10000
+CONTACTS_CACHE_SIZE = 10000
+# Names per IN (...) list, well below the bound parameter limit of older SQLite builds
+IN_CHUNK_SIZE = 500
+# Record types of the JSON Lines export, written in this order so that an import always knows the users first
+RECORD_USER = 'user'
+RECORD_CONTACT = 'contact'
+RECORD_LOGIN = 'login'
+RECORD_LOGIN_DAILY = 'login_daily'
+IMPORT_BATCH_SIZE = 10000
+
+
+def create_sqlite_engine(db_path, pragmas, pool_size, read_only=False):
+    db_engine = create_engine(f'sqlite:///{db_path}', echo=False, poolclass=QueuePool, pool_size=pool_size,
+                              max_overflow=0, pool_recycle=RECYCLE_PERIOD, connect_args={'check_same_thread': False})
+
+    @event.listens_for(db_engine, 'connect')
+    def set_pragmas(connection, _):
+        cursor = connection.cursor()
+        # Only takes effect on a new database; existing ones are converted by vacuum()
+        if not read_only:
+            cursor.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        if read_only:
+            cursor.execute('PRAGMA query_only=ON')
+        cursor.close()
+
+    return db_engine
+
+
+class ServerDBStorage(BaseServerStorage):
     class AllUsers:
         id = None
         user_name = None
@@ -20,17 +69,6 @@ class ServerDBStorage:
         def __repr__(self):
             return f'User name: {self.user_name}\nLast login: {self.last_login_time}'
 
-    class CurrentActiveUsers:
-        current_user_address = None
-        current_user_port = None
-        current_user_login_time = None
-
-        def __init__(self, user_id, user_address, user_port, user_login_time):
-            self.current_user_id = user_id
-            self.current_user_address = user_address
-            self.current_user_port = user_port
-            self.current_user_login_time = user_login_time
-
     class LoginHistory:
         history_login_time = None
         history_user_address = None
@@ -59,10 +97,59 @@ class ServerDBStorage:
             self.message_history_sent = 0
             self.message_history_received = 0
 
-    def __init__(self, db_path):
-        self.db_engine = create_engine(f'sqlite:///{db_path}', echo=False, pool_recycle=RECYCLE_PERIOD,
-                                       connect_args={'check_same_thread': False})
+    class OfflineMessage:
+        offline_recipient = None
+        offline_message = None
+        offline_time = None
+
+        def __init__(self, recipient_id, message):
+            self.offline_recipient = recipient_id
+            self.offline_message = message
+            self.offline_time = datetime.datetime.now()
+
+    class ChatGroup:
+        group_name = None
+        group_owner = None
+        group_created = None
+
+        def __init__(self, group_name, owner_id):
+            self.group_name = group_name
+            self.group_owner = owner_id
+            self.group_created = datetime.datetime.now()
+
+    class GroupMember:
+        member_group = None
+        member_user = None
+
+        def __init__(self, group_id, user_id):
+            self.member_group = group_id
+            self.member_user = user_id
+
+    class ChangeLog:
+        change_owner = None
+        change_kind = None
+        change_name = None
+        change_removed = None
+
+        def __init__(self, owner_id, kind, name, removed=False):
+            self.change_owner = owner_id
+            self.change_kind = kind
+            self.change_name = name
+            self.change_removed = removed
+
+    def __init__(self, db_path, profile=DB_PROFILE, readers=DB_READERS, user_cache_size=USER_CACHE_SIZE,
+                 contacts_cache_size=CONTACTS_CACHE_SIZE):
+        if profile not in DB_PROFILES:
+            raise ValueError(f'Unknown database profile {profile}, expected one of {", ".join(DB_PROFILES)}')
+        # All mutations go through the single writer connection, listings and reports use the read-only pool
+        # so WAL lets them run next to message routing
+        self.db_engine = create_sqlite_engine(db_path, DB_PROFILES[profile], 1)
+        self.read_engine = create_sqlite_engine(db_path, DB_PROFILES[profile], readers, read_only=True)
         self.metadata = MetaData()
+        # Users are never renamed or deleted, so a cached id stays valid; contact lists are updated in place
+        # by add_contact and delete_contact after their commit
+        self.user_ids = LRUCache(user_cache_size)
+        self.contacts = LRUCache(contacts_cache_size)
 
         all_users_table = Table(
             'all_users',
@@ -72,16 +159,6 @@ class ServerDBStorage:
             Column('last_login_time', DateTime),
         )
 
-        current_users_table = Table(
-            'current_users',
-            self.metadata,
-            Column('id', Integer, primary_key=True),
-            Column('current_user_id', ForeignKey('all_users.id'), unique=True),
-            Column('current_user_address', String(15)),
-            Column('current_user_port', String(5)),
-            Column('current_user_login_time', DateTime)
-        )
-
         users_history_table = Table(
             'users_history',
             self.metadata,
@@ -89,7 +166,8 @@ class ServerDBStorage:
             Column('history_user', ForeignKey('all_users.id')),
             Column('history_login_time', DateTime),
             Column('history_user_address', String(15)),
-            Column('history_user_port', String(5))
+            Column('history_user_port', String(5)),
+            Index('ix_users_history_user', 'history_user')
         )
 
         user_contacts_table = Table(
@@ -97,7 +175,8 @@ class ServerDBStorage:
             self.metadata,
             Column('id', Integer, primary_key=True),
             Column('contact_user', ForeignKey('all_users.id')),
-            Column('contact_contact', ForeignKey('all_users.id'))
+            Column('contact_contact', ForeignKey('all_users.id')),
+            Index('ux_user_contacts_pair', 'contact_user', 'contact_contact', unique=True)
         )
 
         message_history_table = Table(
@@ -106,103 +185,637 @@ class ServerDBStorage:
             Column('id', Integer, primary_key=True),
             Column('message_history_user', ForeignKey('all_users.id')),
             Column('message_history_sent', Integer),
-            Column('message_history_received', Integer)
+            Column('message_history_received', Integer),
+            Index('ix_message_history_user', 'message_history_user')
+        )
+
+        offline_messages_table = Table(
+            'offline_messages',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('offline_recipient', ForeignKey('all_users.id')),
+            Column('offline_message', Text),
+            Column('offline_time', DateTime),
+            Index('ix_offline_messages_recipient', 'offline_recipient', 'id')
         )
 
-        mapper(self.AllUsers, all_users_table)
-        mapper(self.CurrentActiveUsers, current_users_table)
-        mapper(self.LoginHistory, users_history_table)
-        mapper(self.UserContacts, user_contacts_table)
-        mapper(self.UserMessageHistory, message_history_table)
+        chat_groups_table = Table(
+            'chat_groups',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('group_name', String(50), unique=True),
+            Column('group_owner', ForeignKey('all_users.id')),
+            Column('group_created', DateTime)
+        )
 
-        self.metadata.create_all(self.db_engine)
+        group_members_table = Table(
+            'group_members',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('member_group', ForeignKey('chat_groups.id')),
+            Column('member_user', ForeignKey('all_users.id')),
+            UniqueConstraint('member_group', 'member_user')
+        )
 
-        self.session = sessionmaker(bind=self.db_engine)()
-        self.session.query(self.CurrentActiveUsers).delete()
-        self.session.commit()
+        # Every directory or contact change gets the next id, which doubles as the sync version
+        change_log_table = Table(
+            'change_log',
+            self.metadata,
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('change_owner', ForeignKey('all_users.id'), nullable=True),
+            Column('change_kind', String(10)),
+            Column('change_name', String(50)),
+            Column('change_removed', Boolean, default=False),
+            Index('ix_change_log_owner', 'change_owner', 'id'),
+            sqlite_autoincrement=True
+        )
 
+        # Login history older than the retention policy is rolled up into one row per user and day
+        self.login_daily_table = Table(
+            'login_daily',
+            self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('daily_user', ForeignKey('all_users.id')),
+            Column('daily_date', Date),
+            Column('daily_logins', Integer),
+            UniqueConstraint('daily_user', 'daily_date')
+        )
+
+        self.schema_version_table = Table(
+            'schema_version',
+            self.metadata,
+            Column('version', Integer, primary_key=True),
+            Column('description', String(100)),
+            Column('applied_time', DateTime)
+        )
+
+        self.all_users_table = all_users_table
+        self.users_history_table = users_history_table
+        self.user_contacts_table = user_contacts_table
+        self.message_history_table = message_history_table
+
+        # Classes are mapped once per process; further storages reuse the mapping with their own engine
+        if inspect(self.AllUsers, raiseerr=False) is None:
+            mapper(self.AllUsers, all_users_table)
+            mapper(self.LoginHistory, users_history_table)
+            mapper(self.UserContacts, user_contacts_table)
+            mapper(self.UserMessageHistory, message_history_table)
+            mapper(self.OfflineMessage, offline_messages_table)
+            mapper(self.ChatGroup, chat_groups_table)
+            mapper(self.GroupMember, group_members_table)
+            mapper(self.ChangeLog, change_log_table)
+
+        # Login runs on every connection, so their statements are built once and reused
+        users = all_users_table.c
+        upsert_user = sqlite_insert(all_users_table).values(user_name=bindparam('name'),
+                                                            last_login_time=bindparam('now'))
+        self.upsert_user_statement = upsert_user.on_conflict_do_update(
+            index_elements=[users.user_name], set_={'last_login_time': upsert_user.excluded.last_login_time})
+        self.user_id_statement = select(users.id).where(users.user_name == bindparam('name'))
+        self.new_history_statement = message_history_table.insert().from_select(
+            ['message_history_user', 'message_history_sent', 'message_history_received'],
+            select(bindparam('user_id'), literal(0), literal(0)).where(~exists().where(
+                message_history_table.c.message_history_user == bindparam('user_id'))))
+        self.user_change_statement = change_log_table.insert().values(
+            change_owner=None, change_kind='user', change_name=bindparam('name'), change_removed=False)
+        self.login_history_statement = users_history_table.insert().values(
+            history_user=bindparam('user_id'), history_login_time=bindparam('now'),
+            history_user_address=bindparam('address'), history_user_port=bindparam('port'))
+        counts = message_history_table.c
+        self.history_update_statement = message_history_table.update().where(
+            counts.message_history_user == bindparam('user_id')).values(
+            message_history_sent=counts.message_history_sent + bindparam('sent'),
+            message_history_received=counts.message_history_received + bindparam('received'))
+        self.add_contact_statement = sqlite_insert(user_contacts_table).values(
+            contact_user=bindparam('user_id'), contact_contact=bindparam('contact_id')).on_conflict_do_nothing()
+        self.contact_change_statement = change_log_table.insert().values(
+            change_owner=bindparam('user_id'), change_kind='contact', change_name=bindparam('name'),
+            change_removed=bindparam('removed'))
+        history = users_history_table.c
+        daily = self.login_daily_table.c
+        rollup = sqlite_insert(self.login_daily_table).from_select(
+            ['daily_user', 'daily_date', 'daily_logins'],
+            select(history.history_user, func.date(history.history_login_time), func.count()).where(
+                history.id.between(bindparam('first_id'), bindparam('last_id'))).group_by(
+                history.history_user, func.date(history.history_login_time)))
+        self.rollup_history_statement = rollup.on_conflict_do_update(
+            index_elements=[daily.daily_user, daily.daily_date],
+            set_={'daily_logins': daily.daily_logins + rollup.excluded.daily_logins})
+        import_daily = sqlite_insert(self.login_daily_table).values(
+            daily_user=bindparam('user_id'), daily_date=bindparam('date'), daily_logins=bindparam('logins'))
+        self.import_daily_statement = import_daily.on_conflict_do_update(
+            index_elements=[daily.daily_user, daily.daily_date],
+            set_={'daily_logins': daily.daily_logins + import_daily.excluded.daily_logins})
+        # An imported user keeps the later of both last logins; SQLite's max() is NULL if either side is
+        imported_login = upsert_user.excluded.last_login_time
+        self.import_user_statement = upsert_user.on_conflict_do_update(
+            index_elements=[users.user_name],
+            set_={'last_login_time': func.max(func.coalesce(users.last_login_time, imported_login),
+                                              func.coalesce(imported_login, users.last_login_time))})
+
+        self.migrate()
+
+        self.session = sessionmaker(bind=self.db_engine)()
+        self.read_session = sessionmaker(bind=self.read_engine)
+
+    # Ordered upgrade steps, each applied once and recorded in schema_version. The base step creates the current
+    # schema on a fresh database, so later steps must also be no-ops there.
+    def schema_migrations(self):
+        return [
+            (1, 'base tables', self.create_base_tables),
+            (2, 'lookup indexes and unique contacts', self.add_lookup_indexes),
+            (3, 'daily login aggregates', self.create_login_daily),
+            (4, 'presence moved to memory', self.drop_current_users),
+        ]
+
+    def migrate(self):
+        self.schema_version_table.create(self.db_engine, checkfirst=True)
+        with self.db_engine.connect() as connection:
+            version = connection.execute(select(func.max(self.schema_version_table.c.version))).scalar() or 0
+        for step_version, description, step in self.schema_migrations():
+            if step_version <= version:
+                continue
+            with self.db_engine.begin() as connection:
+                step(connection)
+                connection.execute(self.schema_version_table.insert().values(
+                    version=step_version, description=description, applied_time=datetime.datetime.now()))
+            logger.info(f'Database schema upgraded to version {step_version}: {description}')
+
+    def create_base_tables(self, connection):
+        self.metadata.create_all(connection)
+
+    def add_lookup_indexes(self, connection):
+        contacts = self.user_contacts_table.c
+        first_ids = select(func.min(contacts.id)).group_by(contacts.contact_user, contacts.contact_contact)
+        connection.execute(self.user_contacts_table.delete().where(contacts.id.not_in(first_ids)))
+        for table in (self.users_history_table, self.user_contacts_table, self.message_history_table):
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
+    def create_login_daily(self, connection):
+        self.login_daily_table.create(connection, checkfirst=True)
+
+    def drop_current_users(self, connection):
+        connection.execute(text('DROP TABLE IF EXISTS current_users'))
+
+    def get_user_id(self, user_name):
+        user_id = self.user_ids.get(user_name)
+        if user_id is None:
+            user_id = self.session.execute(self.user_id_statement, {'name': user_name}).scalar()
+            if user_id is not None:
+                self.user_ids.put(user_name, user_id)
+        return user_id
+
+    # {name: id} of the known names; cached ids are taken as is, the rest are looked up with a few IN queries
+    def get_user_ids(self, user_names):
+        user_ids = {}
+        missing = []
+        for name in user_names:
+            user_id = self.user_ids.get(name)
+            if user_id is None:
+                missing.append(name)
+            else:
+                user_ids[name] = user_id
+        users = self.all_users_table.c
+        for start in range(0, len(missing), IN_CHUNK_SIZE):
+            for user_id, name in self.session.execute(select(users.id, users.user_name).where(
+                    users.user_name.in_(missing[start:start + IN_CHUNK_SIZE]))):
+                user_ids[name] = user_id
+                self.user_ids.put(name, user_id)
+        return user_ids
+
+    # Contact ids out of contact_ids that the user already has
+    def existing_contact_ids(self, user_id, contact_ids):
+        contacts = self.user_contacts_table.c
+        existing = set()
+        for start in range(0, len(contact_ids), IN_CHUNK_SIZE):
+            existing.update(self.session.execute(select(contacts.contact_contact).where(
+                contacts.contact_user == user_id,
+                contacts.contact_contact.in_(contact_ids[start:start + IN_CHUNK_SIZE]))).scalars())
+        return existing
+
+    # The whole login is a single transaction; a message history row is created only for a new user,
+    # which is also how a new user is told apart for the change log. A cached id means a known user.
     def login_user(self, user_name, user_address, user_port):
-        query_result = self.session.query(self.AllUsers).filter_by(user_name=user_name)
-        if query_result.count():
-            current_user = query_result.first()
-            current_user.last_login = datetime.datetime.now()
-        else:
-            current_user = self.AllUsers(user_name)
-            self.session.add(current_user)
+        now = datetime.datetime.now()
+        user_id = self.user_ids.get(user_name)
+        try:
+            self.session.execute(self.upsert_user_statement, {'name': user_name, 'now': now})
+            if user_id is None:
+                user_id = self.session.execute(self.user_id_statement, {'name': user_name}).scalar()
+                if self.session.execute(self.new_history_statement, {'user_id': user_id}).rowcount:
+                    self.session.execute(self.user_change_statement, {'name': user_name})
+            login = {'user_id': user_id, 'address': user_address, 'port': user_port, 'now': now}
+            self.session.execute(self.login_history_statement, login)
             self.session.commit()
-            self.session.add(self.UserMessageHistory(current_user.id))
-        self.session.add(self.CurrentActiveUsers(current_user.id, user_address, user_port, datetime.datetime.now()))
-        self.session.add(self.LoginHistory(current_user.id, datetime.datetime.now(), user_address, user_port))
+        except Exception:
+            self.session.rollback()
+            raise
+        self.user_ids.put(user_name, user_id)
+
+    # Applies all counters in one transaction
+    def message_history_bulk_update(self, counters):
+        parameters = []
+        for name, (sent, received) in counters.items():
+            user_id = self.get_user_id(name)
+            if user_id is not None:
+                parameters.append({'user_id': user_id, 'sent': sent, 'received': received})
+        if parameters:
+            self.session.execute(self.history_update_statement, parameters)
         self.session.commit()
 
-    def logout_user(self, user_name):
-        current_user = self.session.query(self.AllUsers).filter_by(user_name=user_name).first()
-        self.session.query(self.CurrentActiveUsers).filter_by(current_user_id=current_user.id).delete()
+    def store_offline_messages(self, user_name, messages, backlog_limit=None):
+        user_id = self.get_user_id(user_name)
+        if user_id is None or not messages:
+            return 0
+        self.session.add_all([self.OfflineMessage(user_id, json.dumps(message)) for message in messages])
+        if backlog_limit:
+            overflow_id = self.session.query(self.OfflineMessage.id).filter_by(
+                offline_recipient=user_id).order_by(self.OfflineMessage.id.desc()).offset(
+                backlog_limit).limit(1).scalar()
+            if overflow_id is not None:
+                self.session.query(self.OfflineMessage).filter(
+                    self.OfflineMessage.offline_recipient == user_id,
+                    self.OfflineMessage.id <= overflow_id).delete(synchronize_session=False)
+        self.session.commit()
+        return len(messages)
+
+    def pop_offline_messages(self, user_name, ttl=None):
+        user_id = self.get_user_id(user_name)
+        if user_id is None:
+            return []
+        query = self.session.query(self.OfflineMessage).filter_by(offline_recipient=user_id)
+        rows = query.with_entities(self.OfflineMessage.offline_message, self.OfflineMessage.offline_time).order_by(
+            self.OfflineMessage.id).all()
+        if not rows:
+            return []
+        query.delete(synchronize_session=False)
         self.session.commit()
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=ttl) if ttl else datetime.datetime.min
+        return [json.loads(message) for message, created in rows if created >= oldest]
 
-    def message_history_update(self, from_user, to_user):
-        from_user = self.session.query(self.AllUsers).filter_by(user_name=from_user).first().id
-        to_user = self.session.query(self.AllUsers).filter_by(user_name=to_user).first().id
-        sender_row = self.session.query(self.UserMessageHistory).filter_by(message_history_user=from_user).first()
-        sender_row.message_history_sent += 1
-        recipient_row = self.session.query(self.UserMessageHistory).filter_by(message_history_user=to_user).first()
-        recipient_row.message_history_received += 1
+    def purge_offline_messages(self, ttl):
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=ttl)
+        deleted = self.session.query(self.OfflineMessage).filter(
+            self.OfflineMessage.offline_time < oldest).delete(synchronize_session=False)
+        self.session.commit()
+        return deleted
+
+    def create_group(self, user_name, group_name):
+        user_id = self.get_user_id(user_name)
+        if user_id is None or self.session.query(self.ChatGroup).filter_by(group_name=group_name).count():
+            return False
+        group = self.ChatGroup(group_name, user_id)
+        self.session.add(group)
+        self.session.flush()
+        self.session.add(self.GroupMember(group.id, user_id))
+        self.session.commit()
+        return True
+
+    def join_group(self, user_name, group_name):
+        user_id = self.get_user_id(user_name)
+        group = self.session.query(self.ChatGroup).filter_by(group_name=group_name).first()
+        if user_id is None or not group:
+            return False
+        if not self.session.query(self.GroupMember).filter_by(member_group=group.id,
+                                                              member_user=user_id).count():
+            self.session.add(self.GroupMember(group.id, user_id))
+            self.session.commit()
+        return True
+
+    def leave_group(self, user_name, group_name):
+        user_id = self.get_user_id(user_name)
+        group = self.session.query(self.ChatGroup).filter_by(group_name=group_name).first()
+        if user_id is None or not group:
+            return False
+        deleted = self.session.query(self.GroupMember).filter_by(
+            member_group=group.id, member_user=user_id).delete(synchronize_session=False)
         self.session.commit()
+        return bool(deleted)
+
+    def group_members_list(self):
+        return self.session.query(self.ChatGroup.group_name, self.AllUsers.user_name).join(
+            self.GroupMember, self.GroupMember.member_group == self.ChatGroup.id).join(
+            self.AllUsers, self.GroupMember.member_user == self.AllUsers.id).all()
 
     def all_users_list(self):
-        return self.session.query(self.AllUsers.user_name, self.AllUsers.last_login_time).all()
+        with self.read_session() as session:
+            return session.query(self.AllUsers.user_name, self.AllUsers.last_login_time).all()
+
+    # Keyset page over the unique user_name index
+    def users_page(self, page_size, after_name=None, prefix=None):
+        with self.read_session() as session:
+            query = session.query(self.AllUsers.user_name)
+            if prefix:
+                prefix_end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                query = query.filter(self.AllUsers.user_name >= prefix, self.AllUsers.user_name < prefix_end)
+            if after_name is not None:
+                query = query.filter(self.AllUsers.user_name > after_name)
+            names = [row[0] for row in query.order_by(self.AllUsers.user_name).limit(page_size + 1)]
+        return names[:page_size], len(names) > page_size
+
+    # Batches are kept small so the writer is never locked for long
+    def rollup_login_history(self, max_age_days, max_rows, batch_size):
+        history = self.users_history_table.c
+        oldest = datetime.datetime.now() - datetime.timedelta(days=max_age_days) if max_age_days else None
+        # Ids only grow and rollups remove the lowest ones, so the newest max_rows rows are those above
+        # max(id) - max_rows; max() is one seek on the primary key, where OFFSET stepped over max_rows rows per batch
+        newest_id = self.session.execute(select(func.max(history.id))).scalar() if max_rows else None
+        cap_id = newest_id - max_rows if newest_id else None
+        first_id = last_id = None
+        for row_id, login_time in self.session.execute(
+                select(history.id, history.history_login_time).order_by(history.id).limit(batch_size)):
+            if not (oldest and login_time < oldest or cap_id and row_id <= cap_id):
+                break
+            first_id = row_id if first_id is None else first_id
+            last_id = row_id
+        if last_id is None:
+            self.session.commit()
+            return 0
+        # Both bounds keep the aggregate on the id range; with only the upper one SQLite walks the whole user index
+        self.session.execute(self.rollup_history_statement, {'first_id': first_id, 'last_id': last_id})
+        deleted = self.session.execute(self.users_history_table.delete().where(history.id <= last_id)).rowcount
+        self.session.commit()
+        return deleted
 
-    def current_users_list(self):
-        return self.session.query(
-            self.AllUsers.user_name,
-            self.CurrentActiveUsers.current_user_address,
-            self.CurrentActiveUsers.current_user_port,
-            self.CurrentActiveUsers.current_user_login_time
-        ).join(self.AllUsers).all()
+    def database_size(self):
+        page_size = self.session.execute(text('PRAGMA page_size')).scalar()
+        page_count = self.session.execute(text('PRAGMA page_count')).scalar()
+        free_pages = self.session.execute(text('PRAGMA freelist_count')).scalar()
+        self.session.commit()
+        return page_count * page_size, free_pages * page_size
+
+    # Pragmas that rewrite pages have to run to completion outside of a transaction, which executescript does
+    def run_maintenance_script(self, script):
+        self.session.commit()
+        self.session.connection().connection.cursor().executescript(script)
+        self.session.commit()
+
+    def incremental_vacuum(self, pages=None):
+        size_before = self.database_size()[0]
+        self.run_maintenance_script(f'PRAGMA incremental_vacuum({pages or 0})')
+        return size_before - self.database_size()[0]
+
+    # Rebuilds the whole file, also switching databases created before incremental vacuum over to it
+    def vacuum(self):
+        size_before = self.database_size()[0]
+        self.run_maintenance_script('PRAGMA auto_vacuum=INCREMENTAL; VACUUM')
+        return size_before - self.database_size()[0]
+
+    # Yields users with their counters, then contacts, then login history and its daily aggregates as plain dicts.
+    # Rows are fetched from the cursor as they are consumed inside one read transaction, so the export is a
+    # consistent snapshot.
+    def export_records(self):
+        users = self.all_users_table.c
+        counts = self.message_history_table.c
+        owners = self.all_users_table.alias('owners')
+        contacts = self.all_users_table.alias('contacts')
+        pairs = self.user_contacts_table.c
+        history = self.users_history_table.c
+        daily = self.login_daily_table.c
+        with self.read_engine.connect() as connection, connection.begin():
+            for name, last_login, sent, received in connection.execute(
+                    select(users.user_name, users.last_login_time, counts.message_history_sent,
+                           counts.message_history_received).outerjoin(
+                        self.message_history_table, counts.message_history_user == users.id).order_by(users.id)):
+                yield {'type': RECORD_USER, 'name': name, 'last_login': last_login.isoformat() if last_login else None,
+                       'sent': sent or 0, 'received': received or 0}
+            for owner, contact in connection.execute(
+                    select(owners.c.user_name, contacts.c.user_name).select_from(self.user_contacts_table).join(
+                        owners, pairs.contact_user == owners.c.id).join(
+                        contacts, pairs.contact_contact == contacts.c.id).order_by(pairs.id)):
+                yield {'type': RECORD_CONTACT, 'user': owner, 'contact': contact}
+            for name, login_time, address, port in connection.execute(
+                    select(users.user_name, history.history_login_time, history.history_user_address,
+                           history.history_user_port).join(
+                        self.all_users_table, history.history_user == users.id).order_by(history.id)):
+                yield {'type': RECORD_LOGIN, 'user': name, 'time': login_time.isoformat(), 'address': address,
+                       'port': port}
+            for name, daily_date, logins in connection.execute(
+                    select(users.user_name, daily.daily_date, daily.daily_logins).join(
+                        self.all_users_table, daily.daily_user == users.id).order_by(daily.id)):
+                yield {'type': RECORD_LOGIN_DAILY, 'user': name, 'date': daily_date.isoformat(), 'logins': logins}
+
+    # Merges exported records into this database: counters and daily logins are added, logins appended and
+    # repeated contacts ignored. Consecutive records of one type are written with executemany, batch_size records
+    # per transaction. Returns {record_type: records}.
+    def import_records(self, records, batch_size=IMPORT_BATCH_SIZE):
+        handlers = {RECORD_USER: self.import_users, RECORD_CONTACT: self.import_contacts,
+                    RECORD_LOGIN: self.import_logins, RECORD_LOGIN_DAILY: self.import_login_daily}
+        imported = dict.fromkeys(handlers, 0)
+        batch = []
+        kind = None
+        for record in records:
+            if record.get('type') not in handlers:
+                raise ValueError(f'Unknown record type: {record.get("type")}')
+            if record['type'] != kind or len(batch) >= batch_size:
+                if batch:
+                    handlers[kind](batch)
+                    self.session.commit()
+                batch = []
+                kind = record['type']
+            batch.append(record)
+            imported[kind] += 1
+        if batch:
+            handlers[kind](batch)
+            self.session.commit()
+        # Imported contacts went around the cache
+        self.contacts.clear()
+        return imported
+
+    def import_users(self, records):
+        names = [record['name'] for record in records]
+        known = self.get_user_ids(names)
+        self.session.execute(self.import_user_statement, [
+            {'name': record['name'],
+             'now': datetime.datetime.fromisoformat(record['last_login']) if record.get('last_login') else None}
+            for record in records])
+        user_ids = self.get_user_ids(names)
+        new_names = [name for name in dict.fromkeys(names) if name not in known]
+        if new_names:
+            self.session.execute(self.user_change_statement, [{'name': name} for name in new_names])
+            self.session.execute(self.new_history_statement, [{'user_id': user_ids[name]} for name in new_names])
+        counters = [{'user_id': user_ids[record['name']], 'sent': record.get('sent', 0),
+                     'received': record.get('received', 0)} for record in records
+                    if record.get('sent') or record.get('received')]
+        if counters:
+            self.session.execute(self.history_update_statement, counters)
+
+    # Contacts of unknown users and pairs already present are skipped, so a repeated import leaves the change log
+    # and client versions alone
+    def import_contacts(self, records):
+        user_ids = self.get_user_ids({name for record in records for name in (record['user'], record['contact'])})
+        owners = {}
+        for record in records:
+            if record['user'] in user_ids and record['contact'] in user_ids:
+                owners.setdefault(record['user'], {})[user_ids[record['contact']]] = record['contact']
+        new_contacts = []
+        for owner, contacts in owners.items():
+            existing = self.existing_contact_ids(user_ids[owner], list(contacts))
+            new_contacts.extend({'user_id': user_ids[owner], 'contact_id': contact_id, 'name': name, 'removed': False}
+                                for contact_id, name in contacts.items() if contact_id not in existing)
+        if new_contacts:
+            self.session.execute(self.add_contact_statement, new_contacts)
+            self.session.execute(self.contact_change_statement, new_contacts)
+
+    def import_logins(self, records):
+        user_ids = self.get_user_ids({record['user'] for record in records})
+        logins = [{'user_id': user_ids[record['user']], 'now': datetime.datetime.fromisoformat(record['time']),
+                   'address': record['address'], 'port': record['port']}
+                  for record in records if record['user'] in user_ids]
+        if logins:
+            self.session.execute(self.login_history_statement, logins)
+
+    def import_login_daily(self, records):
+        user_ids = self.get_user_ids({record['user'] for record in records})
+        days = [{'user_id': user_ids[record['user']], 'date': datetime.date.fromisoformat(record['date']),
+                 'logins': record['logins']} for record in records if record['user'] in user_ids]
+        if days:
+            self.session.execute(self.import_daily_statement, days)
+
+    def close(self):
+        self.session.close()
+        self.db_engine.dispose()
+        self.read_engine.dispose()
+
+    def login_daily_list(self, user_name=None):
+        with self.read_session() as session:
+            query = session.query(
+                self.AllUsers.user_name,
+                self.login_daily_table.c.daily_date,
+                self.login_daily_table.c.daily_logins
+            ).join(self.AllUsers, self.login_daily_table.c.daily_user == self.AllUsers.id)
+            if user_name:
+                query = query.filter(self.AllUsers.user_name == user_name)
+            return query.order_by(self.login_daily_table.c.daily_date).all()
 
     def history_list(self, user_name=None):
-        query = self.session.query(
-            self.AllUsers.user_name,
-            self.LoginHistory.history_login_time,
-            self.LoginHistory.history_user_address,
-            self.LoginHistory.history_user_port
-        ).join(self.AllUsers)
-        if user_name:
-            query = query.filter(self.AllUsers.user_name == user_name)
-        return query.all()
+        with self.read_session() as session:
+            query = session.query(
+                self.AllUsers.user_name,
+                self.LoginHistory.history_login_time,
+                self.LoginHistory.history_user_address,
+                self.LoginHistory.history_user_port
+            ).join(self.AllUsers)
+            if user_name:
+                query = query.filter(self.AllUsers.user_name == user_name)
+            return query.all()
 
     def message_history_list(self):
-        return self.session.query(
-            self.AllUsers.user_name,
-            self.AllUsers.last_login_time,
-            self.UserMessageHistory.message_history_sent,
-            self.UserMessageHistory.message_history_received
-        ).join(self.AllUsers).all()
-
-    def add_contact(self, user, contact):
-        current_user = self.session.query(self.AllUsers).filter_by(user_name=user).first()
-        current_contact = self.session.query(self.AllUsers).filter_by(user_name=contact).first()
-        if not current_user or not current_contact or self.session.query(self.UserContacts).filter_by(
-                contact_user=current_user.id,
-                contact_contact=current_contact.id).count():
-            return
-        self.session.add(self.UserContacts(current_user.id, current_contact.id))
+        with self.read_session() as session:
+            return session.query(
+                self.AllUsers.user_name,
+                self.AllUsers.last_login_time,
+                self.UserMessageHistory.message_history_sent,
+                self.UserMessageHistory.message_history_received
+            ).join(self.AllUsers).all()
+
+    # Keyset pages: the cursor is the (sort value, user id) of the last row, so a page costs the same however deep
+    # it is. Sorting by name walks the unique user_name index; the counters are sorted with a top-N scan instead
+    # of indexes that every counter flush would have to maintain.
+    def message_history_page(self, page_size, sort_column=0, descending=False, cursor=None, name_filter=None):
+        users = self.all_users_table.c
+        counts = self.message_history_table.c
+        # Missing login times sort first instead of dropping out of the row value comparison
+        sort_key = (users.user_name, func.coalesce(users.last_login_time, '', type_=String),
+                    counts.message_history_sent, counts.message_history_received)[sort_column]
+        query = select(users.user_name, users.last_login_time, counts.message_history_sent,
+                       counts.message_history_received, sort_key, users.id).join(
+            self.message_history_table, counts.message_history_user == users.id)
+        if name_filter:
+            query = query.where(users.user_name.contains(name_filter, autoescape=True))
+        if cursor is not None:
+            key = tuple_(sort_key, users.id)
+            query = query.where(key < tuple_(*cursor) if descending else key > tuple_(*cursor))
+        order = (sort_key.desc(), users.id.desc()) if descending else (sort_key, users.id)
+        with self.read_session() as session:
+            rows = session.execute(query.order_by(*order).limit(page_size + 1)).all()
+        page = rows[:page_size]
+        return [tuple(row[:4]) for row in page], tuple(page[-1][4:]) if len(rows) > page_size else None
+
+    # Both batch operations run as one transaction: the names and the existing pairs are resolved with IN queries,
+    # then the changed pairs and their change log rows are written with one executemany each
+    def add_contacts(self, user, contacts):
+        contacts = list(dict.fromkeys(contacts))
+        user_id = self.get_user_id(user)
+        if user_id is None:
+            return dict.fromkeys(contacts, CONTACT_UNKNOWN)
+        contact_ids = self.get_user_ids(contacts)
+        existing = self.existing_contact_ids(user_id, list(contact_ids.values()))
+        added = [name for name in contacts if name in contact_ids and contact_ids[name] not in existing]
+        if added:
+            self.session.execute(self.add_contact_statement,
+                                 [{'user_id': user_id, 'contact_id': contact_ids[name]} for name in added])
+            self.session.execute(self.contact_change_statement,
+                                 [{'user_id': user_id, 'name': name, 'removed': False} for name in added])
         self.session.commit()
-
-    def delete_contact(self, user, contact):
-        current_user = self.session.query(self.AllUsers).filter_by(user_name=user).first()
-        current_contact = self.session.query(self.AllUsers).filter_by(user_name=contact).first()
-        if not current_user or current_contact:
-            return
-        self.session.query(self.UserContacts).filter(self.UserContacts.contact_user == current_user.id,
-                                                     self.UserContacts.contact_contact == current_contact.id).delete()
+        cached = self.contacts.peek(user)
+        if added and cached is not None:
+            self.contacts.put(user, cached + tuple(added))
+        added = set(added)
+        return {name: CONTACT_ADDED if name in added else CONTACT_UNCHANGED if name in contact_ids else CONTACT_UNKNOWN
+                for name in contacts}
+
+    def delete_contacts(self, user, contacts):
+        contacts = list(dict.fromkeys(contacts))
+        user_id = self.get_user_id(user)
+        if user_id is None:
+            return dict.fromkeys(contacts, CONTACT_UNKNOWN)
+        contact_ids = self.get_user_ids(contacts)
+        existing = self.existing_contact_ids(user_id, list(contact_ids.values()))
+        removed = [name for name in contacts if contact_ids.get(name) in existing]
+        if removed:
+            pairs = self.user_contacts_table.c
+            removed_ids = [contact_ids[name] for name in removed]
+            for start in range(0, len(removed_ids), IN_CHUNK_SIZE):
+                self.session.execute(self.user_contacts_table.delete().where(
+                    pairs.contact_user == user_id, pairs.contact_contact.in_(removed_ids[start:start + IN_CHUNK_SIZE])))
+            self.session.execute(self.contact_change_statement,
+                                 [{'user_id': user_id, 'name': name, 'removed': True} for name in removed])
         self.session.commit()
+        removed = set(removed)
+        cached = self.contacts.peek(user)
+        if removed and cached is not None:
+            self.contacts.put(user, tuple(name for name in cached if name not in removed))
+        return {name: CONTACT_REMOVED if name in removed else CONTACT_UNCHANGED if name in contact_ids
+                else CONTACT_UNKNOWN for name in contacts}
+
+    def current_version(self):
+        return self.session.query(func.max(self.ChangeLog.id)).scalar() or 0
+
+    def get_changes(self, user_name, since_version):
+        user_id = self.get_user_id(user_name)
+        version = self.current_version()
+        if user_id is None or since_version <= 0 or since_version > version:
+            return version, True, [], self.get_all_contacts(user_name), []
+        users_added = []
+        contacts = {}
+        for kind, name, removed in self.session.query(
+                self.ChangeLog.change_kind, self.ChangeLog.change_name, self.ChangeLog.change_removed).filter(
+                self.ChangeLog.id > since_version,
+                or_(self.ChangeLog.change_owner.is_(None), self.ChangeLog.change_owner == user_id)).order_by(
+                self.ChangeLog.id):
+            if kind == 'user':
+                users_added.append(name)
+            else:
+                contacts[name] = removed
+        return (version, False, users_added, [name for name, removed in contacts.items() if not removed],
+                [name for name, removed in contacts.items() if removed])
 
     def get_all_contacts(self, user):
-        current_user = self.session.query(self.AllUsers).filter_by(user_name=user).first()
-        query = self.session.query(self.UserContacts, self.AllUsers.user_name).filter_by(
-            contact_user=current_user.id).join(self.AllUsers, self.UserContacts.contact_contact == self.AllUsers.id)
-        return [entry[1] for entry in query.all()]
+        contacts = self.contacts.get(user)
+        if contacts is None:
+            user_id = self.get_user_id(user)
+            if user_id is None:
+                return []
+            query = self.session.query(self.UserContacts, self.AllUsers.user_name).filter_by(
+                contact_user=user_id).join(self.AllUsers, self.UserContacts.contact_contact == self.AllUsers.id)
+            contacts = tuple(entry[1] for entry in query.order_by(self.UserContacts.id))
+            self.contacts.put(user, contacts)
+        return list(contacts)
+
+    def stats(self):
+        return {'user_ids': self.user_ids.stats(), 'contacts': self.contacts.stats()}
 
 
 if __name__ == '__main__':
@@ -213,8 +826,6 @@ if __name__ == '__main__':
     db.login_user('test2', '192.168.1.113', 8081)
     db.login_user('test3', '192.168.1.113', 8080)
     pprint(db.all_users_list())
-    pprint(db.current_users_list())
-    db.logout_user('McG2')
     pprint(db.history_list('re'))
     db.add_contact('test2', 'test1')
     db.add_contact('test1', 'test3')
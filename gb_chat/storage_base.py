@@ -0,0 +1,102 @@
+class BaseServerStorage:
+    def login_user(self, user_name, user_address, user_port):
+        raise NotImplementedError
+
+    def message_history_update(self, from_user, to_user):
+        counters = {from_user: [1, 0]}
+        counters.setdefault(to_user, [0, 0])[1] += 1
+        self.message_history_bulk_update(counters)
+
+    # counters is {user_name: (sent, received)}, applied as increments; unknown names are ignored
+    def message_history_bulk_update(self, counters):
+        raise NotImplementedError
+
+    # Keeps at most backlog_limit newest messages per recipient, returns the number of messages stored
+    def store_offline_messages(self, user_name, messages, backlog_limit=None):
+        raise NotImplementedError
+
+    # Returns and removes all queued messages of the user in the order they were stored, dropping expired ones
+    def pop_offline_messages(self, user_name, ttl=None):
+        raise NotImplementedError
+
+    def purge_offline_messages(self, ttl):
+        raise NotImplementedError
+
+    def create_group(self, user_name, group_name):
+        raise NotImplementedError
+
+    def join_group(self, user_name, group_name):
+        raise NotImplementedError
+
+    def leave_group(self, user_name, group_name):
+        raise NotImplementedError
+
+    # [(group_name, user_name)]
+    def group_members_list(self):
+        raise NotImplementedError
+
+    def add_contact(self, user, contact):
+        self.add_contacts(user, [contact])
+
+    def delete_contact(self, user, contact):
+        self.delete_contacts(user, [contact])
+
+    # Applies the whole list at once, returns {contact: CONTACT_ADDED | CONTACT_UNCHANGED | CONTACT_UNKNOWN}
+    def add_contacts(self, user, contacts):
+        raise NotImplementedError
+
+    # Returns {contact: CONTACT_REMOVED | CONTACT_UNCHANGED | CONTACT_UNKNOWN}
+    def delete_contacts(self, user, contacts):
+        raise NotImplementedError
+
+    def get_all_contacts(self, user):
+        raise NotImplementedError
+
+    def current_version(self):
+        raise NotImplementedError
+
+    # Returns (version, full, users_added, contacts_added, contacts_removed) relative to since_version.
+    # An unknown version (0, or newer than the storage's) gets a full snapshot instead of a diff. The snapshot
+    # carries the contacts only: the user directory can outgrow a message, so clients page it with users_page.
+    def get_changes(self, user_name, since_version):
+        raise NotImplementedError
+
+    # Returns names after after_name, optionally starting with prefix, in name order, and whether more names follow
+    def users_page(self, page_size, after_name=None, prefix=None):
+        raise NotImplementedError
+
+    # [(user_name, last_login_time)]
+    def all_users_list(self):
+        raise NotImplementedError
+
+    # [(user_name, login_time, address, port)]
+    def history_list(self, user_name=None):
+        raise NotImplementedError
+
+    # [(user_name, last_login_time, sent, received)]
+    def message_history_list(self):
+        raise NotImplementedError
+
+    # One page of message_history_list ordered by sort_column, an index into its row, with ties broken per user.
+    # Returns (rows, next_cursor); next_cursor is passed back for the following page and is None after the last one.
+    def message_history_page(self, page_size, sort_column=0, descending=False, cursor=None, name_filter=None):
+        raise NotImplementedError
+
+    # [(user_name, date, logins)] of the rolled up login history
+    def login_daily_list(self, user_name=None):
+        raise NotImplementedError
+
+    # Rolls up one batch of the oldest login rows older than max_age_days or beyond the newest max_rows,
+    # returns the number of rows rolled up
+    def rollup_login_history(self, max_age_days, max_rows, batch_size):
+        raise NotImplementedError
+
+    # Returns the number of bytes reclaimed
+    def incremental_vacuum(self, pages=None):
+        return 0
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
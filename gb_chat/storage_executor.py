@@ -0,0 +1,73 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+logger = logging.getLogger('server_logger')
+
+LATENCY_SAMPLES = 1024
+
+# Serializes storage calls of the executor threads with any other user of the same storage
+db_lock = Lock()
+
+
+class StorageExecutor:
+    def __init__(self, workers=1):
+        # Calls are executed in submission order only with a single worker, which the handlers rely on
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='db')
+        self.stats_lock = Lock()
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.calls_count = 0
+        self.errors_count = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def submit(self, func, *args):
+        with self.stats_lock:
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        return self.executor.submit(self._run, func, args)
+
+    def _run(self, func, args):
+        start = time.perf_counter()
+        try:
+            with db_lock:
+                return func(*args)
+        except Exception:
+            with self.stats_lock:
+                self.errors_count += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self.stats_lock:
+                self.queue_depth -= 1
+                self.calls_count += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.latencies.append(latency)
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'calls': self.calls_count,
+                'errors': self.errors_count,
+                'avg_latency': self.total_latency / self.calls_count if self.calls_count else 0.0,
+                'max_latency': self.max_latency,
+            }
+
+    # Percentiles of the latest LATENCY_SAMPLES call latencies, in seconds
+    def latency_percentiles(self, percentiles=(50, 95, 99)):
+        with self.stats_lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return tuple(0.0 for _ in percentiles)
+        return tuple(latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+                     for percentile in percentiles)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -6,7 +6,7 @@ import os
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
 from unittest import mock
-from gbc_common.util import send_message, get_message
+from gbc_common.util import send_message, get_message, encode_message, MessageReader, HEADER
 from gbc_common.variables import DEFAULT_SERVER_PORT, DEFAULT_SERVER_ADDRESS, MAX_CONNECTIONS
 
 
@@ -46,9 +46,41 @@ class TestUtils(unittest.TestCase):
         self.assertRaises(ValueError, get_message, mock.Mock())
 
     def test_get_message_receives_dicts(self):
-        self.client_socket.send(bytes([1, 2, 3]))
+        self.client_socket.send(HEADER.pack(3) + bytes([1, 2, 3]))
         self.assertRaises(ValueError, get_message, self.client)
 
+    def test_get_message_splits_merged_messages(self):
+        self.client_socket.sendall(encode_message(OK_DICT) + encode_message({'RESPONSE': 400}))
+        self.assertEqual(OK_DICT, get_message(self.client))
+        self.assertEqual({'RESPONSE': 400}, get_message(self.client))
+
+    def test_get_message_reports_closed_connection(self):
+        self.client_socket.close()
+        with self.assertRaises(ConnectionResetError) as raised:
+            get_message(self.client)
+        self.assertTrue(raised.exception.errno)
+
+    def test_sends_message_larger_than_buffer(self):
+        big_dict = {'text': 'x' * 100000}
+        send_message(self.client_socket, big_dict)
+        self.assertEqual(big_dict, get_message(self.client))
+
+
+class TestMessageReader(unittest.TestCase):
+    def test_feed_partial_frame_returns_nothing(self):
+        reader = MessageReader()
+        frame = encode_message(OK_DICT)
+        self.assertEqual([], reader.feed(frame[:2]))
+        self.assertEqual([], reader.feed(frame[2:-1]))
+        self.assertEqual([OK_DICT], reader.feed(frame[-1:]))
+
+    def test_feed_returns_many_messages(self):
+        reader = MessageReader()
+        self.assertEqual([OK_DICT] * 3, reader.feed(encode_message(OK_DICT) * 3))
+
+    def test_feed_rejects_oversized_frame(self):
+        self.assertRaises(ValueError, MessageReader().feed, HEADER.pack(2 ** 31))
+
 
 
 if __name__ == '__main__':
@@ -0,0 +1,52 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from presence import PresenceRegistry
+
+
+class TestPresenceRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.presence = PresenceRegistry(tombstones=2)
+        self.presence.login('alice', '127.0.0.1', 7001)
+        self.presence.login('bob', '127.0.0.1', 7002)
+
+    def test_snapshot_lists_online_users(self):
+        version, entries = self.presence.snapshot()
+        self.assertEqual(2, version)
+        self.assertEqual([('alice', '127.0.0.1', 7001), ('bob', '127.0.0.1', 7002)],
+                         [entry[:3] for entry in entries])
+        self.assertIn('alice', self.presence)
+        self.assertEqual(2, len(self.presence))
+
+    def test_diff_returns_changes_since_version(self):
+        version, _ = self.presence.snapshot()
+        self.presence.count_message('alice', ['bob', 'unknown'])
+        self.presence.logout('bob')
+        self.presence.logout('unknown')
+        new_version, full, changed, removed = self.presence.diff(version)
+        self.assertFalse(full)
+        self.assertEqual([('alice', 1, 0)], [(entry.name, entry.sent, entry.received) for entry in changed])
+        self.assertEqual(['bob'], removed)
+        self.assertEqual((new_version, False, [], []), self.presence.diff(new_version))
+
+    def test_relogin_clears_removal(self):
+        version, _ = self.presence.snapshot()
+        self.presence.logout('bob')
+        self.presence.login('bob', '127.0.0.1', 7003)
+        _, _, changed, removed = self.presence.diff(version)
+        self.assertEqual([('bob', 7003)], [(entry.name, entry.port) for entry in changed])
+        self.assertEqual([], removed)
+
+    def test_diff_past_dropped_removals_is_full(self):
+        self.presence.login('carol', '127.0.0.1', 7003)
+        version, _ = self.presence.snapshot()
+        for name in ('alice', 'bob', 'carol'):
+            self.presence.logout(name)
+        self.assertEqual((6, True, [], []), self.presence.diff(version))
+
+
+if __name__ == '__main__':
+    unittest.main()
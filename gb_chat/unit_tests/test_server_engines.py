@@ -0,0 +1,191 @@
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from gbc_common.util import get_message, send_message
+from gbc_common.variables import *
+from memory_storage import ServerMemoryStorage
+from server import GBChatServer
+from async_server import GBChatAsyncServer
+
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+# Enough to fill the kernel buffers of both sockets on loopback and then the server's outbound queue
+FLOOD_MESSAGES = 400
+FLOOD_TEXT = 'x' * 32 * 1024
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def wait_until(condition, timeout=10):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+# Runs against both engines, the test cases below provide server_class and reading_paused
+class EngineTests:
+    def setUp(self) -> None:
+        self.port = free_port()
+        self.server = self.server_class('127.0.0.1', self.port, ServerMemoryStorage(), high_water=HIGH_WATER,
+                                        low_water=LOW_WATER)
+        self.server.start()
+        self.sockets = []
+
+    def tearDown(self) -> None:
+        for sock in self.sockets:
+            sock.close()
+        self.server.stop()
+        self.server.join(5)
+
+    def connect(self, name, receive_buffer=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receive_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        self.assertTrue(wait_until(lambda: sock.connect_ex(('127.0.0.1', self.port)) == 0))
+        self.sockets.append(sock)
+        sock.settimeout(10)
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(), USER: {ACCOUNT_NAME: name}})
+        self.assertEqual(200, get_message(sock)[RESPONSE])
+        self.assertTrue(wait_until(lambda: name in self.server.clients_names and
+                                   not self.server.clients_names[name].backlog_pending))
+        return sock
+
+    def send_flood(self):
+        try:
+            for _ in range(FLOOD_MESSAGES):
+                send_message(self.writer, {ACTION: MESSAGE, TIME: time.time(), MESSAGE_TEXT: FLOOD_TEXT,
+                                           SENDER: 'writer', DESTINATION: 'reader'})
+        except OSError:
+            # tearDown closed the socket of a writer that is still paused
+            pass
+
+    # The reader never reads until told to, so the writer ends up paused by the server
+    def start_flood(self):
+        self.reader = self.connect('reader', receive_buffer=4096)
+        self.writer = self.connect('writer')
+        self.flood = threading.Thread(target=self.send_flood, daemon=True)
+        self.flood.start()
+        reader, writer = self.server.clients_names['reader'], self.server.clients_names['writer']
+        self.assertTrue(wait_until(lambda: writer.blocking_recipients == {reader}))
+        return reader, writer
+
+    def test_sender_is_paused_past_high_water(self):
+        reader, writer = self.start_flood()
+        self.assertTrue(reader.congested)
+        self.assertEqual({writer}, reader.blocked_senders)
+        self.assertTrue(self.reading_paused(writer))
+        self.assertTrue(self.flood.is_alive())
+
+    def test_sender_resumes_below_low_water(self):
+        reader, writer = self.start_flood()
+        received = sum(1 for _ in range(FLOOD_MESSAGES) if get_message(self.reader)[MESSAGE_TEXT] == FLOOD_TEXT)
+        self.assertEqual(FLOOD_MESSAGES, received)
+        self.flood.join(10)
+        self.assertFalse(self.flood.is_alive())
+        self.assertFalse(reader.congested)
+        self.assertEqual((set(), set()), (reader.blocked_senders, writer.blocking_recipients))
+        self.assertFalse(self.reading_paused(writer))
+
+    def test_recipient_disconnect_releases_paused_sender(self):
+        reader, writer = self.start_flood()
+        self.reader.close()
+        self.assertTrue(wait_until(lambda: 'reader' not in self.server.clients_names))
+        self.assertEqual(set(), writer.blocking_recipients)
+        self.assertTrue(wait_until(lambda: not self.reading_paused(writer)))
+        self.flood.join(10)
+        self.assertFalse(self.flood.is_alive())
+        self.assertIn('writer', self.server.clients_names)
+
+    # A paused sender is not read, so its disconnect is seen once the recipient drained and reading resumed
+    def test_paused_sender_disconnect_is_cleaned_up(self):
+        reader, writer = self.start_flood()
+        self.writer.close()
+        self.reader.settimeout(1)
+        with self.assertRaises(socket.timeout):
+            while True:
+                get_message(self.reader)
+        self.assertTrue(wait_until(lambda: 'writer' not in self.server.clients_names))
+        self.assertEqual((set(), set()), (reader.blocked_senders, writer.blocking_recipients))
+        self.assertFalse(reader.congested)
+
+    def send_text(self, sock, sender, destination, text):
+        send_message(sock, {ACTION: MESSAGE, TIME: time.time(), MESSAGE_TEXT: text, SENDER: sender,
+                            DESTINATION: destination})
+
+    def test_message_is_delivered_in_order(self):
+        alice, bob = self.connect('alice'), self.connect('bob')
+        for number in range(20):
+            self.send_text(alice, 'alice', 'bob', f'hello {number}')
+        self.assertEqual([f'hello {number}' for number in range(20)],
+                         [get_message(bob)[MESSAGE_TEXT] for _ in range(20)])
+
+    def test_offline_message_is_delivered_on_login(self):
+        self.connect('bob').close()
+        self.assertTrue(wait_until(lambda: 'bob' not in self.server.clients_names))
+        alice = self.connect('alice')
+        self.send_text(alice, 'alice', 'bob', 'see you later')
+        self.assertTrue(wait_until(lambda: self.server.storage.users['bob'].offline_messages))
+        bob = self.connect('bob')
+        message = get_message(bob)
+        self.assertEqual(('alice', 'see you later'), (message[SENDER], message[MESSAGE_TEXT]))
+
+    def request_group(self, sock, action, name):
+        send_message(sock, {ACTION: action, TIME: time.time(), USER: name, GROUP_NAME: 'team'})
+        return get_message(sock)[RESPONSE]
+
+    def test_group_join_is_recorded_before_fan_out(self):
+        owner, member = self.connect('owner'), self.connect('member')
+        self.assertEqual(200, self.request_group(owner, GROUP_CREATE, 'owner'))
+        self.assertEqual(200, self.request_group(member, GROUP_JOIN, 'member'))
+        self.assertEqual({'owner', 'member'}, self.server.groups['team'])
+
+    def test_group_join_refused_by_storage_is_not_fanned_out(self):
+        owner, member = self.connect('owner'), self.connect('member')
+        self.assertEqual(200, self.request_group(owner, GROUP_CREATE, 'owner'))
+        self.server.storage.join_group = lambda user_name, group_name: False
+        self.assertEqual(400, self.request_group(member, GROUP_JOIN, 'member'))
+        self.assertEqual({'owner'}, self.server.groups['team'])
+
+    def test_group_join_failing_in_storage_is_not_fanned_out(self):
+        owner, member = self.connect('owner'), self.connect('member')
+        self.assertEqual(200, self.request_group(owner, GROUP_CREATE, 'owner'))
+
+        def join_group(user_name, group_name):
+            raise RuntimeError('database is locked')
+
+        self.server.storage.join_group = join_group
+        self.assertEqual(400, self.request_group(member, GROUP_JOIN, 'member'))
+        self.assertEqual({'owner'}, self.server.groups['team'])
+
+
+class TestSelectorsEngine(EngineTests, unittest.TestCase):
+    server_class = GBChatServer
+
+    @staticmethod
+    def reading_paused(client):
+        return client.reading_paused
+
+
+class TestAsyncioEngine(EngineTests, unittest.TestCase):
+    server_class = GBChatAsyncServer
+
+    @staticmethod
+    def reading_paused(client):
+        return not client.transport.is_reading()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from PyQt5.QtTest import QAbstractItemModelTester
+
+from PyQt5.QtCore import Qt, QCoreApplication
+
+from memory_storage import ServerMemoryStorage
+from presence import PresenceRegistry, PresenceEvent, LOGIN_EVENT, STATS_EVENT
+from server_gui import ActiveUsersModel, HistoryModel, ServerEventBridge
+
+app = None
+
+
+def setUpModule():
+    global app
+    app = QCoreApplication.instance() or QCoreApplication([])
+
+
+class TestActiveUsersModel(unittest.TestCase):
+    def setUp(self) -> None:
+        self.presence = PresenceRegistry(tombstones=4)
+        for port, name in enumerate(('alice', 'bob', 'carol', 'dave'), 7001):
+            self.presence.login(name, '127.0.0.1', port)
+        self.model = ActiveUsersModel(self.presence)
+        # Checks every emitted insert, remove and change signal against the model contents
+        self.tester = QAbstractItemModelTester(self.model, QAbstractItemModelTester.FailureReportingMode.Fatal)
+
+    def names(self):
+        return [self.model.index(row, 0).data() for row in range(self.model.rowCount())]
+
+    def test_refresh_applies_only_changes(self):
+        inserted, removed, changed = [], [], []
+        self.model.rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+        self.model.rowsRemoved.connect(lambda parent, first, last: removed.append((first, last)))
+        self.model.dataChanged.connect(lambda top, bottom: changed.append((top.row(), bottom.row())))
+        self.assertFalse(self.model.refresh())
+
+        self.presence.logout('bob')
+        self.presence.logout('carol')
+        self.presence.count_message('dave', ['alice'])
+        self.presence.login('erin', '127.0.0.1', 7005)
+        self.assertTrue(self.model.refresh())
+        self.assertEqual(['alice', 'dave', 'erin'], self.names())
+        self.assertEqual([(1, 2)], removed)
+        self.assertEqual([(2, 2)], inserted)
+        self.assertEqual([(0, 1)], changed)
+        self.assertEqual(['dave', '1', '0'], [self.model.index(1, column).data() for column in (0, 4, 5)])
+
+    def test_refresh_resets_after_missed_removals(self):
+        for name in ('alice', 'bob', 'carol', 'dave'):
+            self.presence.logout(name)
+        self.presence.login('erin', '127.0.0.1', 7005)
+        self.presence.logout('erin')
+        self.presence.login('frank', '127.0.0.1', 7006)
+        self.assertTrue(self.model.refresh())
+        self.assertEqual(['frank'], self.names())
+
+
+class TestHistoryModel(unittest.TestCase):
+    def setUp(self) -> None:
+        self.storage = ServerMemoryStorage()
+        for number in range(5):
+            self.storage.login_user(f'user-{number}', '127.0.0.1', 7001)
+        self.storage.message_history_bulk_update({f'user-{number}': (number % 3, 0) for number in range(5)})
+        self.model = HistoryModel(self.storage, page_size=2)
+        self.tester = QAbstractItemModelTester(self.model, QAbstractItemModelTester.FailureReportingMode.Fatal)
+
+    def fetch_all(self):
+        while self.model.canFetchMore():
+            self.model.fetchMore()
+        return [self.model.index(row, 0).data() for row in range(self.model.rowCount())]
+
+    def test_rows_are_fetched_in_pages(self):
+        self.model.restart()
+        # The tester fetches on its own after a reset, but only whole pages
+        self.assertEqual(0, self.model.rowCount() % 2)
+        self.assertTrue(self.model.canFetchMore())
+        self.assertEqual([f'user-{number}' for number in range(5)], self.fetch_all())
+
+    def test_sort_and_filter_restart_paging(self):
+        self.model.sort(2, Qt.DescendingOrder)
+        self.assertEqual(['user-2', 'user-4', 'user-1', 'user-3', 'user-0'], self.fetch_all())
+        self.model.set_name_filter('3')
+        self.assertEqual(['user-3'], self.fetch_all())
+        self.assertEqual('0', self.model.index(0, 3).data())
+
+
+class TestServerEventBridge(unittest.TestCase):
+    def setUp(self) -> None:
+        self.bridge = ServerEventBridge(window=100)
+        self.batches = []
+        self.bridge.events_ready.connect(self.batches.append)
+
+    def process_events(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            app.processEvents()
+
+    def test_first_event_is_delivered_at_once_and_the_rest_batched(self):
+        def post_events():
+            for number in range(100):
+                self.bridge.post(PresenceEvent(LOGIN_EVENT, f'user-{number}'))
+                self.bridge.post(PresenceEvent(STATS_EVENT, None))
+
+        poster = threading.Thread(target=post_events)
+        self.bridge.post(PresenceEvent(LOGIN_EVENT, 'alice'))
+        self.process_events(0.01)
+        self.assertEqual([[PresenceEvent(LOGIN_EVENT, 'alice')]], self.batches)
+        poster.start()
+        poster.join()
+        self.process_events(0.05)
+        self.assertEqual(1, len(self.batches))
+        self.process_events(0.1)
+        self.assertEqual([101], [len(batch) for batch in self.batches[1:]])
+        self.process_events(0.15)
+        self.assertEqual(2, len(self.batches))
+        self.assertFalse(self.bridge.scheduled)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from server_metrics import ServerMetrics, process_rss
+from storage_executor import StorageExecutor
+
+
+class TestServerMetrics(unittest.TestCase):
+    def test_samples_hold_rates_and_are_bounded(self):
+        metrics = ServerMetrics(samples=2)
+        metrics.accepted, metrics.disconnected = 3, 1
+        metrics.messages = 10
+        time.sleep(0.01)
+        sample = metrics.sample(128, (0.001, 0.002, 0.003), 4096)
+        self.assertEqual(2, sample.connections)
+        self.assertGreater(sample.messages_rate, 0)
+        self.assertEqual((128, 0.003, 4096), (sample.outbound_bytes, sample.db_p99, sample.rss))
+        metrics.sample(0, (0.0, 0.0, 0.0), None)
+        metrics.sample(0, (0.0, 0.0, 0.0), None)
+        history = metrics.history()
+        self.assertEqual(2, len(history))
+        self.assertEqual(0, history[-1].messages_rate)
+
+    def test_process_rss_is_reported(self):
+        self.assertGreater(process_rss(), 0)
+
+    def test_storage_latency_percentiles(self):
+        executor = StorageExecutor()
+        self.assertEqual((0.0, 0.0, 0.0), executor.latency_percentiles())
+        executor.latencies.extend(number / 1000 for number in range(1, 101))
+        self.assertEqual((0.051, 0.096, 0.1), executor.latency_percentiles())
+        executor.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import configparser
+import os
+import subprocess
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from memory_storage import ServerMemoryStorage
+from server import GBChatServerStarter, parse_arguments
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class TestServerStartup(unittest.TestCase):
+    def test_headless_flag(self):
+        with patch.object(sys, 'argv', ['server.py', '--headless', '-e', 'asyncio']):
+            self.assertEqual(('', 7777, 'asyncio', True), parse_arguments(7777, ''))
+
+    def test_headless_default_comes_from_config(self):
+        with patch.object(sys, 'argv', ['server.py']):
+            self.assertEqual(('', 7777, 'threaded', True), parse_arguments(7777, '', default_headless=True))
+            self.assertFalse(parse_arguments(7777, '')[3])
+
+    def test_memory_storage_is_created_without_sqlalchemy(self):
+        config = configparser.ConfigParser()
+        config.read_dict({'SETTINGS': {'Storage': 'memory'}})
+        self.assertIsInstance(GBChatServerStarter.create_storage(config['SETTINGS']), ServerMemoryStorage)
+
+    def test_unknown_storage_is_rejected(self):
+        config = configparser.ConfigParser()
+        config.read_dict({'SETTINGS': {'Storage': 'csv'}})
+        with self.assertRaises(ValueError):
+            GBChatServerStarter.create_storage(config['SETTINGS'])
+
+    # A fresh interpreter, the modules imported by the other tests must not hide a top-level import
+    def test_headless_imports_leave_out_gui_and_sqlalchemy(self):
+        loaded = subprocess.run(
+            [sys.executable, '-c', 'import sys, server, memory_storage; '
+                                   'print(*sorted({m.split(".")[0] for m in sys.modules} & {"PyQt5", "sqlalchemy"}))'],
+            cwd=SERVER_DIR, capture_output=True, text=True, check=True).stdout
+        self.assertEqual('', loaded.strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,304 @@
+import datetime
+import itertools
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from gbc_common.variables import CONTACT_ADDED, CONTACT_REMOVED, CONTACT_UNCHANGED, CONTACT_UNKNOWN
+from memory_storage import ServerMemoryStorage
+from server_storage import ServerDBStorage
+
+db_dir = None
+storage = None
+user_numbers = itertools.count()
+
+
+def setUpModule():
+    global db_dir, storage
+    db_dir = tempfile.TemporaryDirectory()
+    storage = ServerDBStorage(os.path.join(db_dir.name, 'server_db.sqlite'))
+
+
+def tearDownModule():
+    storage.close()
+    db_dir.cleanup()
+
+
+# Behaviour every storage engine has to share; engine test cases provide create_storage and open_storage
+class StorageTests:
+    def setUp(self) -> None:
+        self.storage = self.create_storage()
+        number = next(user_numbers)
+        self.alice, self.bob = f'alice-{number}', f'bob-{number}'
+        self.storage.login_user(self.alice, '127.0.0.1', 7001)
+        self.storage.login_user(self.bob, '127.0.0.1', 7002)
+
+    def get_counters(self, *names):
+        counters = {name: (sent, received) for name, _, sent, received in self.storage.message_history_list()}
+        return {name: counters[name] for name in names}
+
+    def test_login_user_updates_existing_user(self):
+        first_login = dict(self.storage.all_users_list())[self.alice]
+        version = self.storage.current_version()
+        self.storage.login_user(self.alice, '127.0.0.1', 7003)
+        self.storage.login_user(self.alice, '127.0.0.1', 7004)
+        self.assertGreater(dict(self.storage.all_users_list())[self.alice], first_login)
+        self.assertEqual(('127.0.0.1', '7004'), self.storage.history_list(self.alice)[-1][2:])
+        self.assertEqual(3, len(self.storage.history_list(self.alice)))
+        self.assertEqual(version, self.storage.current_version())
+        self.assertEqual((0, 0), self.get_counters(self.alice)[self.alice])
+
+    def test_message_history_update_counts_one_message(self):
+        self.storage.message_history_update(self.alice, self.bob)
+        self.assertEqual({self.alice: (1, 0), self.bob: (0, 1)}, self.get_counters(self.alice, self.bob))
+
+    def test_message_history_bulk_update_adds_deltas(self):
+        self.storage.message_history_bulk_update({self.alice: (3, 1), self.bob: (1, 3)})
+        self.storage.message_history_bulk_update({self.alice: (2, 0), 'unknown': (5, 5)})
+        self.assertEqual({self.alice: (5, 1), self.bob: (1, 3)}, self.get_counters(self.alice, self.bob))
+
+    def test_offline_messages_are_popped_in_order(self):
+        messages = [{'mess_text': f'text {number}'} for number in range(3)]
+        self.assertEqual(3, self.storage.store_offline_messages(self.bob, messages))
+        self.assertEqual(messages, self.storage.pop_offline_messages(self.bob))
+        self.assertEqual([], self.storage.pop_offline_messages(self.bob))
+
+    def test_offline_messages_backlog_is_bounded(self):
+        messages = [{'mess_text': f'text {number}'} for number in range(5)]
+        self.storage.store_offline_messages(self.bob, messages, backlog_limit=2)
+        self.assertEqual(messages[-2:], self.storage.pop_offline_messages(self.bob))
+
+    def test_offline_messages_for_unknown_user_are_not_stored(self):
+        self.assertEqual(0, self.storage.store_offline_messages('unknown', [{'mess_text': 'text'}]))
+
+    def test_group_membership(self):
+        group_name = f'group-{self.alice}'
+        self.assertTrue(self.storage.create_group(self.alice, group_name))
+        self.assertFalse(self.storage.create_group(self.bob, group_name))
+        self.assertTrue(self.storage.join_group(self.bob, group_name))
+        self.assertTrue(self.storage.join_group(self.bob, group_name))
+        self.assertTrue(self.storage.leave_group(self.alice, group_name))
+        members = [user for group, user in self.storage.group_members_list() if group == group_name]
+        self.assertEqual([self.bob], members)
+
+    def test_get_changes_returns_full_snapshot_for_unknown_version(self):
+        version, full, users_added, contacts_added, contacts_removed = self.storage.get_changes(self.alice, 0)
+        self.assertTrue(full)
+        self.assertEqual(self.storage.current_version(), version)
+        self.assertEqual([], users_added)
+
+    def test_get_changes_returns_diff_since_version(self):
+        since_version = self.storage.current_version()
+        self.storage.add_contact(self.alice, self.bob)
+        self.storage.login_user(f'new-{self.alice}', '127.0.0.1', 7003)
+        self.storage.add_contact(self.bob, self.alice)
+        version, full, users_added, contacts_added, contacts_removed = self.storage.get_changes(
+            self.alice, since_version)
+        self.assertFalse(full)
+        self.assertEqual(([f'new-{self.alice}'], [self.bob], []), (users_added, contacts_added, contacts_removed))
+
+        self.storage.delete_contact(self.alice, self.bob)
+        changes = self.storage.get_changes(self.alice, version)
+        self.assertEqual(([], [], [self.bob]), changes[2:])
+        self.assertEqual([], self.storage.get_all_contacts(self.alice))
+
+    def test_users_page_walks_names_in_order(self):
+        prefix = f'page-{self.alice}-'
+        names = [f'{prefix}{number}' for number in range(5)]
+        for name in names:
+            self.storage.login_user(name, '127.0.0.1', 7003)
+        first_page, has_more = self.storage.users_page(3, prefix=prefix)
+        self.assertEqual((names[:3], True), (first_page, has_more))
+        self.assertEqual((names[3:], False), self.storage.users_page(3, after_name=first_page[-1], prefix=prefix))
+
+    def test_message_history_pages_follow_sort_order(self):
+        prefix = f'history-{self.alice}-'
+        for number in range(5):
+            self.storage.login_user(f'{prefix}{number}', '127.0.0.1', 7003)
+        self.storage.message_history_bulk_update({f'{prefix}{number}': (number % 2, 0) for number in range(5)})
+        rows, cursor = self.storage.message_history_page(3, sort_column=2, descending=True, name_filter=prefix)
+        self.assertEqual([(f'{prefix}3', 1), (f'{prefix}1', 1), (f'{prefix}4', 0)], [(row[0], row[2]) for row in rows])
+        rows, cursor = self.storage.message_history_page(3, 2, True, cursor, prefix)
+        self.assertEqual(([f'{prefix}2', f'{prefix}0'], None), ([row[0] for row in rows], cursor))
+
+    def test_message_history_pages_follow_new_logins(self):
+        prefix = f'login-{self.alice}-'
+        names = [f'{prefix}{number}' for number in range(3)]
+        for name in names:
+            self.storage.login_user(name, '127.0.0.1', 7003)
+        self.storage.login_user(names[0], '127.0.0.1', 7004)
+        rows, cursor = self.storage.message_history_page(2, sort_column=1, name_filter=prefix)
+        self.assertEqual(names[1:], [row[0] for row in rows])
+        rows, cursor = self.storage.message_history_page(2, 1, False, cursor, prefix)
+        self.assertEqual(([names[0]], None), ([row[0] for row in rows], cursor))
+        self.assertEqual([names[0], names[2]],
+                         [row[0] for row in self.storage.message_history_page(2, 1, True, None, prefix)[0]])
+
+    def test_add_contact_twice_keeps_one_contact(self):
+        version = self.storage.current_version()
+        self.storage.add_contact(self.alice, self.bob)
+        self.storage.add_contact(self.alice, self.bob)
+        self.assertEqual([self.bob], self.storage.get_all_contacts(self.alice))
+        self.assertEqual(version + 1, self.storage.current_version())
+
+    def test_bulk_contacts_report_every_name(self):
+        carol = f'carol-{self.alice}'
+        self.storage.login_user(carol, '127.0.0.1', 7003)
+        self.storage.add_contact(self.alice, self.bob)
+        version = self.storage.current_version()
+        self.assertEqual({self.bob: CONTACT_UNCHANGED, carol: CONTACT_ADDED, 'nobody': CONTACT_UNKNOWN},
+                         self.storage.add_contacts(self.alice, [self.bob, carol, 'nobody', carol]))
+        self.assertEqual([self.bob, carol], self.storage.get_all_contacts(self.alice))
+        self.assertEqual({self.bob: CONTACT_REMOVED, self.alice: CONTACT_UNCHANGED, 'nobody': CONTACT_UNKNOWN},
+                         self.storage.delete_contacts(self.alice, [self.bob, self.alice, 'nobody']))
+        self.assertEqual([carol], self.storage.get_all_contacts(self.alice))
+        _, _, _, contacts_added, contacts_removed = self.storage.get_changes(self.alice, version)
+        self.assertEqual(([carol], [self.bob]), (contacts_added, contacts_removed))
+
+    def test_rollup_login_history_keeps_newest_rows(self):
+        capped_storage = self.open_storage('capped_db.sqlite')
+        for port in range(5):
+            capped_storage.login_user('carol', '127.0.0.1', port)
+        self.assertEqual(3, capped_storage.rollup_login_history(None, 2, 100))
+        self.assertEqual(0, capped_storage.rollup_login_history(None, 2, 100))
+        self.assertEqual(['3', '4'], [row[3] for row in capped_storage.history_list('carol')])
+        self.assertEqual(3, capped_storage.login_daily_list('carol')[0][2])
+        self.assertGreaterEqual(capped_storage.incremental_vacuum(), 0)
+
+
+class TestServerStorage(StorageTests, unittest.TestCase):
+    def create_storage(self):
+        return storage
+
+    def open_storage(self, file_name):
+        other_storage = ServerDBStorage(os.path.join(db_dir.name, file_name))
+        self.addCleanup(other_storage.close)
+        return other_storage
+
+    def test_read_engine_is_read_only_wal(self):
+        with self.storage.read_engine.connect() as connection:
+            self.assertEqual('wal', connection.execute(text('PRAGMA journal_mode')).scalar())
+            with self.assertRaises(OperationalError):
+                connection.execute(text('DELETE FROM all_users'))
+
+    def test_contacts_cache_follows_changes(self):
+        self.assertEqual([], self.storage.get_all_contacts(self.alice))
+        hits = self.storage.contacts.hits
+        self.storage.add_contact(self.alice, self.bob)
+        self.assertEqual([self.bob], self.storage.get_all_contacts(self.alice))
+        self.storage.delete_contact(self.alice, self.bob)
+        self.assertEqual([], self.storage.get_all_contacts(self.alice))
+        self.assertEqual(hits + 2, self.storage.contacts.hits)
+        self.assertIn(self.alice, self.storage.user_ids)
+        self.assertEqual({'user_ids', 'contacts'}, set(self.storage.stats()))
+
+    def test_migrations_upgrade_legacy_database(self):
+        db_path = os.path.join(db_dir.name, 'legacy_db.sqlite')
+        with sqlite3.connect(db_path) as connection:
+            connection.executescript('''
+                CREATE TABLE all_users (id INTEGER PRIMARY KEY, user_name VARCHAR(50) UNIQUE, last_login_time DATETIME);
+                CREATE TABLE user_contacts (id INTEGER PRIMARY KEY, contact_user INTEGER, contact_contact INTEGER);
+                INSERT INTO all_users VALUES (1, 'alice', NULL), (2, 'bob', NULL);
+                INSERT INTO user_contacts (contact_user, contact_contact) VALUES (1, 2), (1, 2), (2, 1);
+            ''')
+        legacy_storage = self.open_storage(db_path)
+        self.assertEqual(['bob'], legacy_storage.get_all_contacts('alice'))
+        with sqlite3.connect(db_path) as connection:
+            indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            versions = [row[0] for row in connection.execute('SELECT version FROM schema_version ORDER BY version')]
+        self.assertTrue({'ix_users_history_user', 'ix_message_history_user', 'ux_user_contacts_pair'} <= indexes)
+        self.assertEqual([1, 2, 3, 4], versions)
+
+    def test_rollup_login_history_aggregates_old_logins(self):
+        aged_storage = self.open_storage('aged_db.sqlite')
+        aged_storage.login_user('carol', '127.0.0.1', 7001)
+        aged_storage.session.execute(aged_storage.users_history_table.delete())
+        old_day = datetime.datetime.now() - datetime.timedelta(days=40)
+        aged_storage.session.execute(aged_storage.users_history_table.insert(), [
+            {'history_user': 1, 'history_login_time': old_day + datetime.timedelta(minutes=minutes),
+             'history_user_address': '127.0.0.1', 'history_user_port': '7001'} for minutes in range(3)])
+        aged_storage.session.commit()
+        aged_storage.login_user('carol', '127.0.0.1', 7002)
+        self.assertEqual(2, aged_storage.rollup_login_history(30, None, 2))
+        self.assertEqual(1, aged_storage.rollup_login_history(30, None, 2))
+        self.assertEqual(0, aged_storage.rollup_login_history(30, None, 2))
+        self.assertEqual([('carol', old_day.date(), 3)], aged_storage.login_daily_list('carol'))
+        self.assertEqual(['7002'], [row[3] for row in aged_storage.history_list('carol')])
+        self.assertGreaterEqual(aged_storage.incremental_vacuum(), 0)
+
+    def test_export_import_round_trip(self):
+        source_storage = self.open_storage('export_db.sqlite')
+        source_storage.login_user('carol', '127.0.0.1', 7001)
+        source_storage.login_user('dave', '127.0.0.1', 7002)
+        source_storage.login_user('carol', '127.0.0.1', 7003)
+        source_storage.add_contacts('carol', ['dave'])
+        source_storage.message_history_update('carol', 'dave')
+        source_storage.rollup_login_history(None, 1, 100)
+        records = list(source_storage.export_records())
+        self.assertEqual(['user', 'user', 'contact', 'login', 'login_daily', 'login_daily'],
+                         [record['type'] for record in records])
+
+        target_storage = self.open_storage('import_db.sqlite')
+        self.assertEqual({'user': 2, 'contact': 1, 'login': 1, 'login_daily': 2},
+                         target_storage.import_records(records, batch_size=2))
+        self.assertEqual(records, list(target_storage.export_records()))
+        self.assertEqual(source_storage.login_daily_list(), target_storage.login_daily_list())
+        self.assertEqual((True, ['dave']), target_storage.get_changes('carol', 0)[1:4:2])
+        self.assertEqual((['carol', 'dave'], False), target_storage.users_page(10))
+        version = target_storage.current_version()
+        target_storage.import_records([record for record in records if record['type'] == 'contact'])
+        self.assertEqual(version, target_storage.current_version())
+        with self.assertRaises(ValueError):
+            target_storage.import_records([{'type': 'unknown'}])
+
+    def test_import_keeps_known_last_login(self):
+        import_storage = self.open_storage('last_login_db.sqlite')
+        import_storage.login_user('carol', '127.0.0.1', 7001)
+        last_login = import_storage.all_users_list()[0][1]
+        import_storage.import_records([{'type': 'user', 'name': 'carol', 'last_login': None},
+                                       {'type': 'user', 'name': 'dave', 'last_login': None}])
+        import_storage.import_records([{'type': 'user', 'name': 'dave', 'last_login': last_login.isoformat()}])
+        self.assertEqual([('carol', last_login), ('dave', last_login)], import_storage.all_users_list())
+
+    def test_unknown_profile_is_rejected(self):
+        with self.assertRaises(ValueError):
+            ServerDBStorage(os.path.join(db_dir.name, 'other_db.sqlite'), profile='unknown')
+
+
+class TestMemoryStorage(StorageTests, unittest.TestCase):
+    def create_storage(self):
+        return ServerMemoryStorage()
+
+    def open_storage(self, file_name):
+        return ServerMemoryStorage()
+
+    def test_snapshot_restores_state(self):
+        snapshot_path = os.path.join(db_dir.name, f'snapshot-{self.alice}.json')
+        snapshot_storage = ServerMemoryStorage(snapshot_path)
+        snapshot_storage.login_user('carol', '127.0.0.1', 7001)
+        snapshot_storage.login_user('dave', '127.0.0.1', 7002)
+        snapshot_storage.add_contact('carol', 'dave')
+        snapshot_storage.message_history_update('carol', 'dave')
+        snapshot_storage.store_offline_messages('dave', [{'mess_text': 'text'}])
+        snapshot_storage.create_group('carol', 'group')
+        snapshot_storage.close()
+
+        restored = ServerMemoryStorage(snapshot_path)
+        self.assertEqual(snapshot_storage.current_version(), restored.current_version())
+        self.assertEqual(['dave'], restored.get_all_contacts('carol'))
+        self.assertEqual(snapshot_storage.message_history_list(), restored.message_history_list())
+        self.assertEqual(snapshot_storage.message_history_page(10, 1), restored.message_history_page(10, 1))
+        self.assertEqual([('group', 'carol')], restored.group_members_list())
+        self.assertEqual([{'mess_text': 'text'}], restored.pop_offline_messages('dave'))
+        self.assertEqual((['carol', 'dave'], False), restored.users_page(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
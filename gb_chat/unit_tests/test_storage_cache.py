@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from storage_cache import LRUCache
+
+
+class TestLRUCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = LRUCache(2)
+        self.cache.put('alice', 1)
+        self.cache.put('bob', 2)
+
+    def test_least_recently_used_is_evicted(self):
+        self.assertEqual(1, self.cache.get('alice'))
+        self.cache.put('carol', 3)
+        self.assertIsNone(self.cache.get('bob'))
+        self.assertEqual(['alice', 'carol'], list(self.cache.items))
+
+    def test_hits_and_misses_are_counted(self):
+        self.cache.get('alice')
+        self.cache.get('unknown')
+        self.cache.peek('bob')
+        self.assertEqual({'size': 2, 'maxsize': 2, 'hits': 1, 'misses': 1, 'hit_rate': 0.5}, self.cache.stats())
+
+    def test_pop_and_clear(self):
+        self.assertEqual(1, self.cache.pop('alice'))
+        self.assertIsNone(self.cache.pop('alice'))
+        self.cache.clear()
+        self.assertEqual(0, len(self.cache))
+
+
+if __name__ == '__main__':
+    unittest.main()
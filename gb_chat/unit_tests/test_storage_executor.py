@@ -0,0 +1,57 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from storage_executor import StorageExecutor, db_lock
+
+
+class TestStorageExecutor(unittest.TestCase):
+    def setUp(self) -> None:
+        self.executor = StorageExecutor()
+
+    def tearDown(self) -> None:
+        self.executor.shutdown()
+
+    def test_calls_run_off_the_caller_thread_in_submission_order(self):
+        calls = []
+        futures = [self.executor.submit(lambda number: calls.append((number, threading.current_thread().name)),
+                                        number) for number in range(50)]
+        for future in futures:
+            future.result(5)
+        self.assertEqual(list(range(50)), [number for number, _ in calls])
+        self.assertTrue(all(name.startswith('db') for _, name in calls))
+
+    def test_calls_hold_the_db_lock(self):
+        self.assertTrue(self.executor.submit(db_lock.locked).result(5))
+        self.assertFalse(db_lock.locked())
+
+    def test_errors_reach_the_future_and_are_counted(self):
+        future = self.executor.submit(lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            future.result(5)
+        self.executor.submit(lambda: None).result(5)
+        stats = self.executor.stats()
+        self.assertEqual((2, 1, 0), (stats['calls'], stats['errors'], stats['queue_depth']))
+        self.assertFalse(db_lock.locked())
+
+    def test_queue_depth_is_tracked(self):
+        gate = threading.Event()
+        futures = [self.executor.submit(gate.wait, 5) for _ in range(3)]
+        self.assertEqual(3, self.executor.stats()['queue_depth'])
+        gate.set()
+        for future in futures:
+            future.result(5)
+        stats = self.executor.stats()
+        self.assertEqual((0, 3), (stats['queue_depth'], stats['max_queue_depth']))
+
+    def test_latency_percentiles(self):
+        self.assertEqual((0.0, 0.0), self.executor.latency_percentiles((50, 99)))
+        self.executor.latencies.extend(number / 100 for number in range(1, 101))
+        self.assertEqual((0.51, 0.96, 1.0), self.executor.latency_percentiles())
+
+
+if __name__ == '__main__':
+    unittest.main()